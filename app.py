@@ -1,21 +1,126 @@
 # -*- coding: utf-8 -*-
 # app.py
 
-from botlib.module import Dev, Janken, Player
-from botlib.sys.config import Config
-from botlib.sys.util import add_all_commands
-from discord import Intents
-from discord.ext.commands import Bot
+from botlib.sys.startup import StartupTimer, warm_up
 
+timer = StartupTimer()
 
-bot = Bot(command_prefix="!", intents=Intents().all())
+with timer.phase("import"):
+    from argparse import ArgumentParser
+    from asyncio import to_thread
+    from botlib.sys.bus import InvalidationBus, LocalBus
+    from botlib.sys.config import Config
+    from botlib.sys.governor import (ResourceGovernor, activity_middleware,
+                                     gateway_options)
+    from botlib.sys.metrics import Metrics, start_metrics_server
+    from botlib.sys.util import (add_all_app_commands, add_all_commands,
+                                 add_dispatch_middleware)
+    from discord.ext.commands import AutoShardedBot, Bot
+    from os import environ
 
 
-add_all_commands(bot, Dev())
-add_all_commands(bot, Janken())
-add_all_commands(bot, Player())
+APP_COMMANDS = Config.get("APP_COMMANDS", "false").lower() == "true"
+INGEST_INTERVAL = float(Config.get("INGEST_INTERVAL", "0"))
+
+add_dispatch_middleware(activity_middleware)
+
+
+def create_bot(**options) -> Bot:
+    """
+    Build the bot with every module registered.
+
+    :param options: extra bot options, e.g. shard_ids and shard_count
+    :return: bot
+    """
+    cls = AutoShardedBot if "shard_ids" in options else Bot
+    if APP_COMMANDS and environ.get("HOLOBOT_WORKER_INDEX", "0") != "0":
+        # the command list is global, so only one shard worker uploads it
+        # and the others only match their commands with it
+        options.update(rollout_register_new=False, rollout_update_known=False,
+                       rollout_delete_unknown=False)
+    bot = cls(command_prefix="!", **gateway_options(), **options)
+    Metrics().gauge("holobot_voice_clients", "Connected voice clients",
+                    lambda: len(bot.voice_clients))
+
+    with timer.phase("register"):
+        # the command modules are imported here, their heavy dependencies
+        # only when the warm-up builds the singletons that use them
+        from botlib.module import Dev, Janken, Player
+        for wrapper in (Dev(), Janken(), Player()):
+            add_all_commands(bot, wrapper)
+            if APP_COMMANDS:
+                add_all_app_commands(bot, wrapper)
+
+    @bot.event
+    async def on_ready():
+        if "connect" not in timer.phases:
+            # on_ready is dispatched again after every reconnect
+            timer.stop("connect")
+            await start_metrics_server()
+            from botlib.module.janken import JankenRecorder
+            from botlib.module.player import MusicSearcher
+            from botlib.sys.manager import GuildConfigStore, StorageManager
+            guild_ids = [guild.id for guild in bot.guilds]
+            await warm_up(timer,
+                          {"warm-up: storage": StorageManager},
+                          {"warm-up: guild configures": lambda:
+                              GuildConfigStore().load_many(guild_ids),
+                           "warm-up: searcher": MusicSearcher,
+                           "warm-up: recorder": JankenRecorder})
+            await InvalidationBus.get().start()
+            bot.guild_conf_task = bot.loop.create_task(
+                GuildConfigStore().run())
+            # guilds that never use the bot are collected once idle
+            for guild_id in guild_ids:
+                ResourceGovernor().touch(guild_id)
+            bot.governor_task = bot.loop.create_task(
+                ResourceGovernor().run(bot))
+            # one worker transcodes, the others follow the bus messages
+            if INGEST_INTERVAL and environ.get("HOLOBOT_WORKER_INDEX",
+                                               "0") == "0":
+                from botlib.sys.ingest import CatalogIngest
+                bot.ingest_task = bot.loop.create_task(
+                    CatalogIngest().run(INGEST_INTERVAL))
+            print(timer.report())
+
+    @bot.event
+    async def on_guild_remove(guild):
+        ResourceGovernor().forget(guild.id)
+
+    close = bot.close
+
+    async def close_and_flush():
+        await close()
+        # configures changed since the last batch are written back once
+        from botlib.sys.manager import GuildConfigStore
+        try:
+            await to_thread(GuildConfigStore().flush)
+        except Exception as e:
+            print(f"Guild configure flush failed: {e!r}")
+
+    bot.close = close_and_flush
+
+    timer.start("connect")
+    return bot
 
 
 if __name__ == "__main__":
+    parser = ArgumentParser(description="Holobot")
+    parser.add_argument("--shards", type=int, default=0,
+                        help="total gateway shards, enables sharded mode")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="worker processes in sharded mode")
+    args = parser.parse_args()
     TOKEN = Config.get("TOKEN")
-    bot.run(TOKEN)
+    if args.shards and INGEST_INTERVAL and \
+            isinstance(InvalidationBus.get(), LocalBus):
+        # worker 0 ingests, and a local bus never reaches the other workers
+        parser.error("INGEST_INTERVAL with --shards needs a BUS_BACKEND "
+                     "other than local")
+    if args.shards:
+        from botlib.module.player import prepare_shared_assets
+        from botlib.sys.shard import ShardSupervisor
+        supervisor = ShardSupervisor(TOKEN, args.shards, args.processes)
+        supervisor.run(prepare=prepare_shared_assets)
+    else:
+        create_bot().run(TOKEN)
@@ -0,0 +1,2 @@
+# -*- coding: utf-8 -*-
+# bench/__init__.py
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+# bench/catalog.py
+
+from bench.fakes import FakeS3
+from datetime import date, timedelta
+from json import dumps as dumps_json
+from os.path import join as path_combine
+from random import Random
+from shutil import which
+from sqlite3 import connect as connect_db
+from string import ascii_letters, digits
+from subprocess import DEVNULL, run
+from tempfile import NamedTemporaryFile
+
+__all__ = ["generate_catalog", "generate_janken_history", "synthetic_audio"]
+
+# track ids are two characters of author and two of music
+_ID_CHARS = digits + ascii_letters
+_HANGUL = [chr(i) for i in range(0xAC00, 0xD7A4)]
+_KANA = [chr(i) for i in range(0x30A1, 0x30FB)]
+_KANJI = [chr(i) for i in range(0x4E00, 0x9FA0)]
+_LATIN = ["blue", "star", "night", "dream", "sky", "song", "heart", "light",
+          "road", "snow", "fire", "moon", "time", "story", "promise"]
+
+
+def _code(index: int) -> str:
+    high, low = divmod(index, len(_ID_CHARS))
+    return _ID_CHARS[high] + _ID_CHARS[low]
+
+
+def _word(rng: Random, alphabet: list[str]) -> str:
+    return "".join(rng.choice(alphabet) for _ in range(rng.randint(2, 5)))
+
+
+def _title(rng: Random, locale: str) -> str:
+    words = [rng.choice(_LATIN) for _ in range(rng.randint(1, 3))]
+    if locale == "ko":
+        words.append(_word(rng, _HANGUL))
+    words.append(_word(rng, rng.choice([_KANA, _KANJI])))
+    rng.shuffle(words)
+    return " ".join(words)
+
+
+def synthetic_audio(seconds: float = 3.0) -> bytes | None:
+    """
+    Encode a sine tone to Opus in WebM with FFmpeg.
+
+    :param seconds: duration
+    :return: file body, None if FFmpeg is not installed
+    """
+    if which("ffmpeg") is None:
+        return None
+    with NamedTemporaryFile(suffix=".webm") as file:
+        run(["ffmpeg", "-y", "-loglevel", "error", "-f", "lavfi", "-i",
+             f"sine=frequency=440:duration={seconds}", "-c:a", "libopus",
+             "-b:a", "96k", file.name], check=True, stdout=DEVNULL)
+        return file.read()
+
+
+def generate_catalog(s3: FakeS3, entry: str, authors: int = 1000,
+                     tracks: int = 8, audio_tracks: int = 4,
+                     seed: int = 0) -> list[str]:
+    """
+    Seed a synthetic music catalog in the player resource layout.
+
+    :param s3: S3 stand-in to seed
+    :param entry: PLAYER_RESOURCE_ENTRY
+    :param authors: number of authors, at most 3844
+    :param tracks: tracks per author, at most 62
+    :param audio_tracks: tracks that get real Opus audio, if FFmpeg exists
+    :param seed: random seed
+    :return: every track id
+    """
+    rng = Random(seed)
+    audio = synthetic_audio() if audio_tracks else None
+    author_codes = [_code(i) for i in range(authors)]
+    ids = []
+    for author in author_codes:
+        names = {"en": _word(rng, list("aeioukstnmr")).capitalize(),
+                 "ko": _word(rng, _HANGUL)}
+        schemas = {"en": {}, "ko": {}}
+        for i in range(tracks):
+            id_ = author + _code(i)
+            ids.append(id_)
+            for locale, schema in schemas.items():
+                schema[_code(i)] = {
+                    "title": _title(rng, locale),
+                    "authors": [names[locale]] + [
+                        _word(rng, _HANGUL) for _ in range(rng.randint(0, 2))],
+                    "alias": _title(rng, locale),
+                    "id": id_,
+                }
+            body = audio if audio and len(ids) <= audio_tracks else b"\0" * 64
+            s3.seed(path_combine(entry, author, _code(i), "resource.webm"),
+                    body)
+            s3.seed(path_combine(entry, author, _code(i), "thumbnail.webp"),
+                    b"RIFF\0\0\0\0WEBP")
+        for locale, schema in schemas.items():
+            s3.seed(path_combine(entry, author, f"schema_{locale}.json"),
+                    dumps_json(schema, ensure_ascii=False))
+        # servers without a locale read the untranslated schema
+        s3.seed(path_combine(entry, author, "schema_none.json"),
+                dumps_json(schemas["en"], ensure_ascii=False))
+    s3.seed(path_combine(entry, "root.json"),
+            dumps_json({"authors": author_codes}))
+    return ids
+
+
+def generate_janken_history(s3: FakeS3, entry: str, users: int = 2000,
+                            records: int = 50, seed: int = 0) -> list[str]:
+    """
+    Seed a synthetic janken.sqlite with a history per user.
+
+    :param s3: S3 stand-in to seed
+    :param entry: JANKEN_DATA_ENTRY
+    :param users: number of users
+    :param records: records per user
+    :param seed: random seed
+    :return: every user id
+    """
+    rng = Random(seed)
+    user_ids = [str(10 ** 17 + i) for i in range(users)]
+    start = date(2022, 1, 1)
+    with NamedTemporaryFile(suffix=".sqlite") as file:
+        db = connect_db(file.name)
+        db.execute("CREATE TABLE Records (id TEXT, result TEXT, date TEXT)")
+        db.executemany(
+            "INSERT INTO Records (id, result, date) VALUES (?, ?, ?)",
+            [(user, rng.choice(("Win", "Lose", "Draw")),
+              (start + timedelta(days=day)).strftime("%Y-%m-%d"))
+             for user in user_ids for day in range(records)])
+        db.commit()
+        db.close()
+        s3.seed(path_combine(entry, "janken.sqlite"), file.read())
+    return user_ids
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# bench/environment.py
+
+from bench.fakes import FakeS3
+from os import environ
+from os.path import abspath, dirname
+from os.path import join as path_combine
+
+__all__ = ["REPO_PATH", "setup_environment"]
+
+REPO_PATH = dirname(dirname(abspath(__file__)))
+
+
+def setup_environment(workdir: str, s3: FakeS3, **overrides: str) -> str:
+    """
+    Write a global configure for a scratch directory and point the bot at
+    the S3 stand-in. Must run before anything from botlib is imported.
+
+    :param workdir: scratch directory for the configure, cache and index
+    :param s3: S3 stand-in
+    :param overrides: extra configure keys
+    :return: configure path
+    """
+    conf = {
+        "TOKEN": "",
+        "AWS_PUBLIC_KEY": "bench", "AWS_PRIVATE_KEY": "bench",
+        "AWS_REGION": "local", "AWS_S3_NAME": "bench",
+        "BASE_PATH": REPO_PATH + "/", "LOCALE_PATH": "locale/",
+        "CACHE_PATH": path_combine(workdir, "cache") + "/",
+        "INDEX_PATH": path_combine(workdir, "index") + "/",
+        "SERVER_CONF_ENTRY": "dynamic/server-configure/",
+        "JANKEN_DATA_ENTRY": "dynamic/janken/",
+        "PLAYER_DATA_ENTRY": "dynamic/player/",
+        "JANKEN_RESOURCE_ENTRY": "static/media/janken/",
+        "PLAYER_RESOURCE_ENTRY": "static/media/player/",
+        "METRICS_PORT": "0",
+    }
+    conf.update(overrides)
+    path = path_combine(workdir, "global-configure.conf")
+    with open(path, "w", encoding="utf-8") as file:
+        file.writelines(f"{k}={v}\n" for k, v in conf.items())
+    environ["HOLOBOT_CONF_PATH"] = path
+    from botlib.sys.manager import StorageManager
+    StorageManager(client=s3)
+    return path
@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+# bench/fakes.py
+
+from asyncio import get_running_loop, sleep, start_server
+from hashlib import md5
+from io import BytesIO
+from threading import Lock
+from time import perf_counter
+from time import sleep as block
+
+__all__ = ["FakeS3", "FakeS3Error", "FakeAuthor", "FakeBot", "FakeChannel",
+           "FakeContext", "FakeGuild", "FakeRedis", "FakeVoiceClient"]
+
+
+class FakeS3Error(Exception):
+    """
+    Mimics botocore's ClientError closely enough for StorageManager.
+    """
+
+    def __init__(self, status: int, code: str):
+        super().__init__(code)
+        self.response = {"ResponseMetadata": {"HTTPStatusCode": status},
+                         "Error": {"Code": code}}
+
+
+class FakeS3:
+    """
+    An in-process stand-in for the subset of the boto3 S3 client in use.
+    Every request blocks for the given latency, like a real round-trip.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self._objects: dict[str, bytes] = {}
+        self._lock = Lock()
+        self.latency = latency
+        self.requests = 0
+
+    def _round_trip(self):
+        self.requests += 1
+        if self.latency:
+            block(self.latency)
+
+    def get_object(self, Bucket: str, Key: str, **kwargs) -> dict:
+        self._round_trip()
+        with self._lock:
+            if Key not in self._objects:
+                raise FakeS3Error(404, "NoSuchKey")
+            data = self._objects[Key]
+        return {"Body": BytesIO(data), "ContentLength": len(data),
+                "ETag": f'"{md5(data).hexdigest()}"'}
+
+    def head_object(self, Bucket: str, Key: str, **kwargs) -> dict:
+        self._round_trip()
+        with self._lock:
+            if Key not in self._objects:
+                raise FakeS3Error(404, "NoSuchKey")
+            data = self._objects[Key]
+        return {"ContentLength": len(data),
+                "ETag": f'"{md5(data).hexdigest()}"'}
+
+    def put_object(self, Bucket: str, Key: str, Body: bytes,
+                   IfMatch: str | None = None, IfNoneMatch: str | None = None,
+                   **kwargs) -> dict:
+        self._round_trip()
+        if hasattr(Body, "read"):
+            Body = Body.read()
+        with self._lock:
+            current = self._objects.get(Key)
+            if IfNoneMatch == "*" and current is not None or \
+                    IfMatch is not None and (current is None or IfMatch !=
+                                             f'"{md5(current).hexdigest()}"'):
+                raise FakeS3Error(412, "PreconditionFailed")
+            self._objects[Key] = bytes(Body)
+        return {"ETag": f'"{md5(Body).hexdigest()}"'}
+
+    def delete_object(self, Bucket: str, Key: str, **kwargs) -> dict:
+        self._round_trip()
+        with self._lock:
+            self._objects.pop(Key, None)
+        return {}
+
+    def upload_file(self, Filename: str, Bucket: str, Key: str, **kwargs):
+        with open(Filename, "rb") as file:
+            self.put_object(Bucket, Key, file.read())
+
+    def list_objects_v2(self, Bucket: str, Prefix: str = "",
+                        ContinuationToken: str = "", MaxKeys: int = 1000,
+                        **kwargs) -> dict:
+        self._round_trip()
+        with self._lock:
+            keys = sorted(k for k in self._objects if k.startswith(Prefix))
+        start = int(ContinuationToken or 0)
+        page = keys[start:start + MaxKeys]
+        resp = {"Contents": [{"Key": k, "Size": len(self._objects[k])}
+                             for k in page],
+                "KeyCount": len(page),
+                "IsTruncated": start + MaxKeys < len(keys)}
+        if resp["IsTruncated"]:
+            resp["NextContinuationToken"] = str(start + MaxKeys)
+        return resp
+
+    def seed(self, key: str, data: str | bytes):
+        """
+        Store an object without counting a request.
+        """
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        with self._lock:
+            self._objects[key] = data
+
+
+class FakeRedis:
+    """
+    A local stand-in for the Redis pub/sub commands RedisBus uses.
+    """
+
+    def __init__(self):
+        self._subscribers: dict[bytes, set] = {}
+        self._clients: set = set()
+        self._server = None
+        self.published = 0
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        """
+        Listen for clients.
+
+        :param host: address
+        :param port: tcp port, any free port if 0
+        :return: bound port
+        """
+        self._server = await start_server(self._serve, host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            for writer in list(self._clients):
+                writer.close()
+            self._subscribers.clear()
+            await self._server.wait_closed()
+
+    async def _serve(self, reader, writer):
+        # botlib reads the configure on import, which the bench writes first
+        from botlib.sys.bus import encode_command, read_reply
+        channels = []
+        self._clients.add(writer)
+        try:
+            while True:
+                command = await read_reply(reader)
+                match command[0].upper():
+                    case b"PING":
+                        writer.write(b"+PONG\r\n")
+                    case b"AUTH":
+                        writer.write(b"+OK\r\n")
+                    case b"SUBSCRIBE":
+                        for count, channel in enumerate(command[1:], 1):
+                            self._subscribers.setdefault(
+                                channel, set()).add(writer)
+                            channels.append(channel)
+                            writer.write(b"*3\r\n" + encode_command(
+                                "subscribe", channel)[4:] +
+                                b":%d\r\n" % count)
+                    case b"PUBLISH":
+                        targets = self._subscribers.get(command[1], set())
+                        for target in list(targets):
+                            target.write(encode_command(
+                                "message", command[1], command[2]))
+                        self.published += 1
+                        writer.write(b":%d\r\n" % len(targets))
+                    case _:
+                        writer.write(b"-ERR unknown command\r\n")
+                await writer.drain()
+        except (ConnectionError, EOFError, IndexError, RuntimeError):
+            pass
+        finally:
+            self._clients.discard(writer)
+            for channel in channels:
+                self._subscribers.get(channel, set()).discard(writer)
+            writer.close()
+
+
+class FakeAuthor:
+    def __init__(self, id_: int, channel: "FakeChannel | None" = None):
+        self.id = id_
+        self.name = f"user{id_}"
+        self.discriminator = "0000"
+        self.bot = False
+        self.voice = None
+        if channel is not None:
+            self.voice = type("VoiceState", (), {"channel": channel})()
+
+
+class FakeVoiceClient:
+    """
+    A voice client that records when audio would start instead of playing.
+    """
+
+    def __init__(self, guild: "FakeGuild", channel: "FakeChannel"):
+        self.guild = guild
+        self.channel = channel
+        self.source = None
+        self.started: float | None = None
+        self._after = None
+
+    def is_playing(self) -> bool:
+        return self.source is not None
+
+    def is_paused(self) -> bool:
+        return False
+
+    def is_connected(self) -> bool:
+        return self.guild.voice_client is self
+
+    def play(self, source, after=None):
+        self.source = source
+        self.started = perf_counter()
+        self._after = after
+
+    def _cleanup(self):
+        # the real player cleans up the source, which ends FFmpeg
+        if self.source is not None and hasattr(self.source, "cleanup"):
+            self.source.cleanup()
+        self.source = None
+
+    def stop(self):
+        self._cleanup()
+
+    def finish(self):
+        """
+        End the current track as if the audio ran out.
+        """
+        self._cleanup()
+        if self._after is not None:
+            self._after(None)
+
+    async def move_to(self, channel: "FakeChannel"):
+        await sleep(0)
+        self.channel = channel
+
+    async def disconnect(self, force: bool = False):
+        self._cleanup()
+        if self.guild.voice_client is self:
+            self.guild.voice_client = None
+
+
+class FakeChannel:
+    def __init__(self, guild: "FakeGuild", id_: int):
+        self.guild = guild
+        self.id = id_
+        self.members: list[FakeAuthor] = []
+
+    async def connect(self, **kwargs) -> FakeVoiceClient:
+        await sleep(0)
+        self.guild.voice_client = FakeVoiceClient(self.guild, self)
+        return self.guild.voice_client
+
+
+class FakeGuild:
+    def __init__(self, id_: int):
+        self.id = id_
+        self.voice_client: FakeVoiceClient | None = None
+        self.channel = FakeChannel(self, id_ * 10)
+
+
+class FakeBot:
+    def __init__(self, guilds: list[FakeGuild] = ()):
+        self.loop = get_running_loop()
+        self.guilds = list(guilds)
+        self.commands: dict[str, object] = {}
+        self._guilds = {guild.id: guild for guild in self.guilds}
+
+    @property
+    def voice_clients(self) -> list[FakeVoiceClient]:
+        return [i.voice_client for i in self.guilds if i.voice_client]
+
+    def add_command(self, command):
+        for name in (command.name, *command.aliases):
+            self.commands[name] = command
+
+    def get_guild(self, id_: int) -> FakeGuild | None:
+        return self._guilds.get(id_)
+
+    async def is_owner(self, user) -> bool:
+        return True
+
+
+class FakeContext:
+    """
+    A command context that records what the bot would send.
+    """
+
+    def __init__(self, bot: FakeBot, guild: FakeGuild, author: FakeAuthor):
+        self.bot = bot
+        self.guild = guild
+        self.author = author
+        self.sent: list[tuple[tuple, dict]] = []
+
+    @property
+    def voice_client(self) -> FakeVoiceClient | None:
+        return self.guild.voice_client
+
+    async def send(self, *args, **kwargs):
+        await sleep(0)
+        # discord.py closes the files it sends
+        for file in [kwargs.get("file"), *kwargs.get("files", ())]:
+            if file is not None:
+                file.close()
+        self.sent.append((args, kwargs))
+
+    async def reply(self, *args, **kwargs):
+        await self.send(*args, **kwargs)
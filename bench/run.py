@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+# bench/run.py
+
+"""
+Benchmarks for the storage, search, player and janken paths.
+
+    python -m bench.run [--authors 1000] [--compare bench/results/<rev>.json]
+
+Everything runs against an in-process S3 stand-in seeded with a synthetic
+catalog, so no credentials or network are needed. FFmpeg is only needed
+for the time-to-first-audio benchmark, which is skipped without it.
+"""
+
+from argparse import ArgumentParser
+from asyncio import run as run_async
+from bench.catalog import generate_catalog, generate_janken_history
+from bench.environment import REPO_PATH, setup_environment
+from bench.fakes import FakeAuthor, FakeBot, FakeContext, FakeGuild, FakeS3
+from json import dump as dump_json
+from json import load as load_json
+from os import environ, makedirs
+from os.path import dirname
+from os.path import join as path_combine
+from platform import python_version
+from random import Random
+from shutil import which
+from statistics import median, quantiles
+from subprocess import check_output, run
+from sys import executable, exit
+from tempfile import mkdtemp
+from time import perf_counter
+
+__all__ = ["main"]
+
+
+def _percentiles(samples: list[float]) -> dict[str, float]:
+    if len(samples) < 2:
+        samples = samples * 2
+    cuts = quantiles(samples, n=100, method="inclusive")
+    return {"p50": cuts[49], "p99": cuts[98]}
+
+
+def _revision() -> str:
+    try:
+        return check_output(["git", "rev-parse", "--short", "HEAD"],
+                            cwd=REPO_PATH, text=True).strip()
+    except Exception:
+        return "unknown"
+
+
+def bench_cold_start(repeat: int) -> float:
+    # a fresh interpreter per run, or the import cache hides the cost
+    code = ("from time import perf_counter; t = perf_counter(); import app; "
+            "app.create_bot(); print(perf_counter() - t)")
+    samples = []
+    for _ in range(repeat):
+        out = run([executable, "-c", code], cwd=REPO_PATH, env=environ,
+                  capture_output=True, text=True, check=True).stdout
+        samples.append(float(out.strip().splitlines()[-1]))
+    return median(samples)
+
+
+def bench_index_build(repeat: int) -> dict[str, float]:
+    from botlib.module.player import MusicSearcher
+    start = perf_counter()
+    searcher = MusicSearcher()
+    first = perf_counter() - start
+    samples = []
+    for _ in range(repeat):
+        start = perf_counter()
+        searcher._build()
+        samples.append(perf_counter() - start)
+    return {"first_s": first, "rebuild_s": median(samples)}
+
+
+def bench_search(ids: list[str], count: int, seed: int) -> dict[str, float]:
+    from botlib.module.player import Music, MusicSearcher
+    from botlib.sys.manager import Locale
+    rng = Random(seed)
+    queries = []
+    for id_ in rng.sample(ids, min(count, len(ids))):
+        locale = rng.choice([Locale.ENGLISH, Locale.KOREAN])
+        music = Music.create(locale, id_)
+        words = (music.title + " " + " ".join(music.authors)).split()
+        queries.append((rng.choice(words + [id_]), locale))
+    samples = []
+    for query, locale in queries:
+        start = perf_counter()
+        MusicSearcher().search(query, locale)
+        samples.append(perf_counter() - start)
+    return {k + "_ms": v * 1000 for k, v in _percentiles(samples).items()}
+
+
+async def _play(ids: list[str]) -> dict[str, float] | None:
+    from botlib.module.player import MusicQueue, Player
+    from botlib.sys.manager import Locale, LocaleProperties
+    bot = FakeBot()
+    locale = LocaleProperties("player", Locale.ENGLISH)
+    cold, warm = [], []
+    for round_, samples in enumerate((cold, warm)):
+        for i, id_ in enumerate(ids):
+            guild = FakeGuild(round_ * len(ids) + i + 1)
+            ctx = FakeContext(bot, guild, FakeAuthor(i, guild.channel))
+            start = perf_counter()
+            await Player.play(ctx, locale, id_)
+            voice = guild.voice_client
+            if voice is None or voice.started is None:
+                return None
+            samples.append(voice.started - start)
+            if hasattr(voice.source, "cleanup"):
+                voice.source.cleanup()
+            voice.stop()
+            await Player.leave(ctx)
+            MusicQueue().free(ctx)
+    return {"cold_ms": median(cold) * 1000, "warm_ms": median(warm) * 1000}
+
+
+def bench_play(ids: list[str]) -> dict[str, float] | None:
+    if not ids:
+        return None
+    return run_async(_play(ids))
+
+
+def bench_recorder(users: list[str], count: int,
+                   seed: int) -> dict[str, float]:
+    from botlib.module.janken import JankenRecorder, JankenResult
+    rng = Random(seed)
+    recorder = JankenRecorder()
+    start = perf_counter()
+    for _ in range(count):
+        recorder.read_all(rng.choice(users))
+    read = count / (perf_counter() - start)
+    start = perf_counter()
+    for _ in range(count):
+        recorder.write(rng.choice(users), rng.choice(list(JankenResult)))
+    write = count / (perf_counter() - start)
+    return {"read_per_s": read, "write_per_s": write}
+
+
+def _flatten(results: dict, prefix: str = "") -> dict[str, float]:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f"{prefix}{key}."))
+        elif value is not None:
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> bool:
+    """
+    Print the change of every benchmark against a baseline.
+
+    :param current: current results
+    :param baseline: baseline results
+    :param threshold: allowed relative slowdown
+    :return: True if nothing regressed beyond the threshold
+    """
+    ok = True
+    now, before = _flatten(current), _flatten(baseline)
+    for key in sorted(now.keys() & before.keys()):
+        if not before[key]:
+            continue
+        change = now[key] / before[key] - 1
+        # throughput goes up when things get faster, everything else down
+        slower = -change if key.endswith("_per_s") else change
+        mark = "REGRESSED" if slower > threshold else ""
+        ok = ok and not mark
+        print(f"{key:<32}{before[key]:>12.4g}{now[key]:>12.4g}"
+              f"{change:>+9.1%} {mark}")
+    return ok
+
+
+def main(argv: list[str] | None = None):
+    parser = ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--authors", type=int, default=1000)
+    parser.add_argument("--tracks", type=int, default=8)
+    parser.add_argument("--audio-tracks", type=int, default=4)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--records", type=int, default=50)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--operations", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--s3-latency-ms", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output")
+    parser.add_argument("--compare")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    workdir = mkdtemp(prefix="holobot-bench-")
+    s3 = FakeS3(args.s3_latency_ms / 1000)
+    setup_environment(workdir, s3)
+    from botlib.sys.config import Config
+    ids = generate_catalog(s3, Config.get("PLAYER_RESOURCE_ENTRY"),
+                           args.authors, args.tracks, args.audio_tracks,
+                           args.seed)
+    users = generate_janken_history(s3, Config.get("JANKEN_DATA_ENTRY"),
+                                    args.users, args.records, args.seed)
+
+    results = {
+        "cold_start_s": bench_cold_start(args.repeat),
+        "index_build": bench_index_build(args.repeat),
+        "search": bench_search(ids, args.queries, args.seed),
+        "play_time_to_first_audio": bench_play(
+            ids[:args.audio_tracks] if which("ffmpeg") else []),
+        "recorder": bench_recorder(users, args.operations, args.seed),
+    }
+    revision = _revision()
+    report = {"revision": revision, "python": python_version(),
+              "parameters": vars(args), "results": results,
+              "s3_requests": s3.requests}
+    output = args.output or path_combine(REPO_PATH, "bench", "results",
+                                         f"{revision}.json")
+    makedirs(dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as file:
+        dump_json(report, file, indent=2)
+    print(f"Results saved to {output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as file:
+            baseline = load_json(file)["results"]
+        if not compare(results, baseline, args.threshold):
+            exit(1)
+    else:
+        for key, value in _flatten(results).items():
+            print(f"{key:<32}{value:>12.4g}")
+
+
+if __name__ == "__main__":
+    main()
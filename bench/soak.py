@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+# bench/soak.py
+
+"""
+Load and soak test that drives the command handlers with simulated guilds.
+
+    python -m bench.soak [--guilds 200] [--rate 50] [--duration 300]
+                         [--mix play=2,search=4,queue=2,janken=2,dev=1]
+
+Commands go through the same dispatch middlewares as in production, from
+fake guilds, users and voice clients against an in-process S3 stand-in.
+The report covers throughput, event loop lag, latency per command, memory
+growth and errors. Playback needs FFmpeg and is left out of the mix
+without it.
+"""
+
+from argparse import ArgumentParser
+from asyncio import create_task, gather, sleep, wait_for
+from asyncio import run as run_async
+from bench.catalog import generate_catalog, generate_janken_history
+from bench.environment import REPO_PATH, setup_environment
+from bench.fakes import FakeAuthor, FakeBot, FakeContext, FakeGuild, FakeS3
+from bench.run import _revision
+from collections import Counter
+from json import dump as dump_json
+from json import dumps as dumps_json
+from os import makedirs
+from os.path import dirname
+from os.path import join as path_combine
+from random import Random
+from shutil import which
+from statistics import linear_regression, quantiles
+from tempfile import mkdtemp
+from time import perf_counter
+
+__all__ = ["main"]
+
+_DEFAULT_MIX = ("play=2,search=4,queue=2,next=1,leave=1,janken=2,record=1,"
+                "dev=1")
+_LAG_INTERVAL = 0.05
+
+
+class _Reservoir:
+    """
+    A fixed-size uniform sample of an unbounded stream, so a long soak
+    does not grow the harness itself.
+    """
+
+    def __init__(self, rng: Random, size: int = 10000):
+        self._rng = rng
+        self._size = size
+        self.samples: list[float] = []
+        self.count = 0
+        self.maximum = 0.0
+
+    def add(self, value: float):
+        self.count += 1
+        self.maximum = max(self.maximum, value)
+        if len(self.samples) < self._size:
+            self.samples.append(value)
+        else:
+            index = self._rng.randrange(self.count)
+            if index < self._size:
+                self.samples[index] = value
+
+    def summary(self, scale: float = 1000.0) -> dict[str, float]:
+        if not self.samples:
+            return {}
+        samples = self.samples * 2 if len(self.samples) < 2 \
+            else self.samples
+        cuts = quantiles(samples, n=100, method="inclusive")
+        return {"p50": cuts[49] * scale, "p95": cuts[94] * scale,
+                "p99": cuts[98] * scale, "max": self.maximum * scale}
+
+
+class _Simulation:
+    """
+    The simulated guilds, their users and the command mix.
+    """
+
+    def __init__(self, args, ids: list[str], users: list[str]):
+        from botlib.module import Dev, Janken, Player
+        from botlib.sys.util import add_all_commands
+        self._rng = Random(args.seed)
+        self.guilds = [FakeGuild(i + 1) for i in range(args.guilds)]
+        self.bot = FakeBot(self.guilds)
+        for wrapper in (Dev(), Janken(), Player()):
+            add_all_commands(self.bot, wrapper)
+        self._player = Player._discord_command_table[0].name
+        self._janken = Janken._discord_command_table[0].name
+        self._ids = ids
+        self._playable = ids[:args.audio_tracks] if which("ffmpeg") else []
+        self._members: dict[int, list[FakeAuthor]] = {}
+        for guild in self.guilds:
+            start = (guild.id - 1) * args.users_per_guild
+            members = [FakeAuthor(int(i), guild.channel) for i in
+                       users[start:start + args.users_per_guild]]
+            guild.channel.members = members
+            self._members[guild.id] = members
+        self.mix = self._parse_mix(args.mix)
+        self.track_seconds = args.track_seconds
+
+    def _parse_mix(self, text: str) -> dict[str, float]:
+        mix = {}
+        for item in text.split(","):
+            name, weight = item.split("=")
+            mix[name.strip()] = float(weight)
+        unknown = mix.keys() - {"play", "search", "queue", "next", "leave",
+                                "janken", "record", "dev"}
+        if unknown:
+            raise ValueError(f"Unknown commands in the mix: {unknown}")
+        if not self._playable:
+            for name in ("play", "next"):
+                if mix.pop(name, None):
+                    print(f"FFmpeg is not installed, '{name}' is skipped.")
+        return mix
+
+    def seed_server_configures(self, s3: FakeS3, entry: str):
+        for guild in self.guilds:
+            s3.seed(path_combine(entry, f"{guild.id}.json"), dumps_json({
+                "AdminID": str(self._members[guild.id][0].id),
+                "Locale": self._rng.choice(["en", "ko"]),
+                "Janken": {"Limit": self._rng.random() < 0.5}}))
+
+    def next_command(self) -> tuple[str, FakeContext, str, tuple]:
+        """
+        Pick the next command of the mix.
+
+        :return: mix name, context, command name, arguments
+        """
+        rng = self._rng
+        kind = rng.choices(list(self.mix), list(self.mix.values()))[0]
+        guild = rng.choice(self.guilds)
+        members = self._members[guild.id]
+        author = rng.choice(members)
+        match kind:
+            case "play":
+                count = rng.choice((1, 1, 1, 3))
+                args = ("play", *rng.sample(self._playable,
+                                            min(count, len(self._playable))))
+                command = self._player
+            case "search":
+                command, args = self._player, ("search",
+                                               rng.choice(self._ids))
+            case "janken":
+                command = self._janken
+                args = (rng.choice(("rock", "paper", "scissors")),)
+            case "record":
+                command, args = self._janken, ("record",)
+            case "dev":
+                author = members[0]
+                command = rng.choice(("dev.ping", "dev.stats", "dev.usage",
+                                      "dev.locale"))
+                args = ()
+            case _:
+                command, args = self._player, (kind,)
+        return kind, FakeContext(self.bot, guild, author), command, args
+
+    async def advance_tracks(self):
+        """
+        End tracks that have played for the track length.
+        """
+        while True:
+            await sleep(0.5)
+            now = perf_counter()
+            for guild in self.guilds:
+                voice = guild.voice_client
+                if voice is not None and voice.started is not None and \
+                        voice.is_playing() and \
+                        now - voice.started >= self.track_seconds:
+                    voice.finish()
+
+
+async def _probe_lag(lag: _Reservoir):
+    # how late a short sleep wakes up is how long the loop was blocked
+    while True:
+        start = perf_counter()
+        await sleep(_LAG_INTERVAL)
+        lag.add(max(0.0, perf_counter() - start - _LAG_INTERVAL))
+
+
+async def _invoke(simulation: _Simulation, latencies: dict, errors: dict,
+                  kind: str, ctx: FakeContext, command: str, args: tuple):
+    start = perf_counter()
+    try:
+        await simulation.bot.commands[command].callback(ctx, *args)
+    except Exception as e:
+        errors.setdefault(kind, Counter())[type(e).__name__] += 1
+    finally:
+        latencies[kind].add(perf_counter() - start)
+
+
+async def _soak(args, s3: FakeS3, ids: list[str], users: list[str]) -> dict:
+    from botlib.module.janken import JankenRecorder
+    from botlib.module.player import MusicSearcher
+    from botlib.sys.governor import memory_usage
+    from botlib.sys.manager import GuildConfigStore, StorageManager
+    from botlib.sys.metrics import Metrics
+    from botlib.sys.startup import StartupTimer, warm_up
+    from botlib.sys.config import Config
+    # the fake bot binds to the running loop
+    simulation = _Simulation(args, ids, users)
+    simulation.seed_server_configures(s3, Config.get("SERVER_CONF_ENTRY"))
+    rng = Random(args.seed + 1)
+    timer = StartupTimer()
+    guild_ids = [guild.id for guild in simulation.guilds]
+    await warm_up(timer, {"storage": StorageManager},
+                  {"guild configures": lambda:
+                      GuildConfigStore().load_many(guild_ids),
+                   "searcher": MusicSearcher, "recorder": JankenRecorder})
+    print(timer.report())
+
+    latencies = {kind: _Reservoir(rng) for kind in simulation.mix}
+    errors: dict[str, Counter] = {}
+    lag = _Reservoir(rng)
+    memory = [(0.0, memory_usage())]
+    background = [create_task(_probe_lag(lag)),
+                  create_task(simulation.advance_tracks()),
+                  create_task(GuildConfigStore().run())]
+    in_flight, dropped = set(), 0
+    if args.tracemalloc:
+        from tracemalloc import start as start_tracing
+        from tracemalloc import take_snapshot
+        start_tracing()
+        before = take_snapshot()
+
+    start = perf_counter()
+    next_at, report_at = start, start + args.report_interval
+    while perf_counter() - start < args.duration:
+        # arrivals are a poisson process, independent of completions
+        next_at += rng.expovariate(args.rate)
+        delay = next_at - perf_counter()
+        if delay > 0:
+            await sleep(delay)
+        if len(in_flight) >= args.max_in_flight:
+            dropped += 1
+        else:
+            task = create_task(_invoke(simulation, latencies, errors,
+                                       *simulation.next_command()))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+        if perf_counter() >= report_at:
+            elapsed = perf_counter() - start
+            memory.append((elapsed, memory_usage()))
+            done = sum(i.count for i in latencies.values())
+            print(f"{elapsed:7.0f}s done={done} rate={done / elapsed:.1f}/s "
+                  f"in-flight={len(in_flight)} dropped={dropped} "
+                  f"lag-p99={lag.summary().get('p99', 0):.1f}ms "
+                  f"rss={memory[-1][1] / 1024 / 1024:.1f}MB "
+                  f"errors={sum(sum(i.values()) for i in errors.values())}")
+            report_at += args.report_interval
+    elapsed = perf_counter() - start
+    if in_flight:
+        try:
+            await wait_for(gather(*in_flight), args.drain_timeout)
+        except TimeoutError:
+            print(f"{len(in_flight)} commands did not finish.")
+    memory.append((perf_counter() - start, memory_usage()))
+    for task in background:
+        task.cancel()
+
+    done = sum(i.count for i in latencies.values())
+    times, sizes = zip(*memory)
+    slope = linear_regression(times, sizes).slope if len(set(times)) > 1 \
+        else 0.0
+    rejected = Metrics().counter("holobot_admission_rejected_total")
+    result = {
+        "throughput_per_s": done / elapsed,
+        "commands": done,
+        "dropped": dropped,
+        "unfinished": len(in_flight),
+        "latency_ms": {k: dict(count=v.count, **v.summary())
+                       for k, v in latencies.items()},
+        "loop_lag_ms": lag.summary(),
+        "memory_mb": {"start": sizes[0] / 1024 / 1024,
+                      "end": sizes[-1] / 1024 / 1024,
+                      "growth_per_hour": slope * 3600 / 1024 / 1024},
+        "errors": {k: dict(v) for k, v in errors.items()},
+        "rejected": {labels["reason"]: rejected.value(**labels)
+                     for labels in rejected.label_sets()},
+    }
+    if args.tracemalloc:
+        stats = take_snapshot().compare_to(before, "lineno")[:10]
+        result["allocation_growth"] = [
+            {"where": str(stat.traceback[0]), "kb": stat.size_diff / 1024}
+            for stat in stats]
+    return result
+
+
+def _print_report(result: dict):
+    print(f"throughput {result['throughput_per_s']:.1f}/s, "
+          f"{result['commands']} commands, {result['dropped']} dropped, "
+          f"{result['unfinished']} unfinished")
+    print(f"{'command':<10}{'count':>8}{'p50':>10}{'p95':>10}{'p99':>10}"
+          f"{'max':>10}  errors")
+    for kind, latency in sorted(result["latency_ms"].items()):
+        errors = result["errors"].get(kind, {})
+        print(f"{kind:<10}{latency['count']:>8}"
+              + "".join(f"{latency.get(i, 0):>10.1f}"
+                        for i in ("p50", "p95", "p99", "max"))
+              + f"  {sum(errors.values())} {errors or ''}")
+    lag = result["loop_lag_ms"]
+    print(f"loop lag ms: p50={lag.get('p50', 0):.1f} "
+          f"p99={lag.get('p99', 0):.1f} max={lag.get('max', 0):.1f}")
+    memory = result["memory_mb"]
+    print(f"memory MB: {memory['start']:.1f} -> {memory['end']:.1f}, "
+          f"{memory['growth_per_hour']:+.1f}/hour")
+    if result["rejected"]:
+        print(f"rejected: {result['rejected']}")
+    for growth in result.get("allocation_growth", []):
+        print(f"  {growth['kb']:>10.1f}KB {growth['where']}")
+
+
+def main(argv: list[str] | None = None):
+    parser = ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--guilds", type=int, default=200)
+    parser.add_argument("--users-per-guild", type=int, default=10)
+    parser.add_argument("--rate", type=float, default=50.0,
+                        help="commands per second")
+    parser.add_argument("--duration", type=float, default=300.0,
+                        help="seconds")
+    parser.add_argument("--mix", default=_DEFAULT_MIX,
+                        help="command=weight pairs")
+    parser.add_argument("--max-in-flight", type=int, default=1000)
+    parser.add_argument("--drain-timeout", type=float, default=30.0)
+    parser.add_argument("--track-seconds", type=float, default=30.0)
+    parser.add_argument("--report-interval", type=float, default=10.0)
+    parser.add_argument("--authors", type=int, default=200)
+    parser.add_argument("--tracks", type=int, default=8)
+    parser.add_argument("--audio-tracks", type=int, default=4)
+    parser.add_argument("--records", type=int, default=20)
+    parser.add_argument("--s3-latency-ms", type=float, default=20.0)
+    parser.add_argument("--tracemalloc", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output")
+    args = parser.parse_args(argv)
+
+    workdir = mkdtemp(prefix="holobot-soak-")
+    s3 = FakeS3(args.s3_latency_ms / 1000)
+    setup_environment(workdir, s3)
+    from botlib.sys.config import Config
+    ids = generate_catalog(s3, Config.get("PLAYER_RESOURCE_ENTRY"),
+                           args.authors, args.tracks, args.audio_tracks,
+                           args.seed)
+    users = generate_janken_history(
+        s3, Config.get("JANKEN_DATA_ENTRY"),
+        args.guilds * args.users_per_guild, args.records, args.seed)
+    for choice in range(3):
+        s3.seed(path_combine(Config.get("JANKEN_RESOURCE_ENTRY"),
+                             str(choice), "Default.mp4"), b"\0" * 1024)
+
+    result = run_async(_soak(args, s3, ids, users))
+    result["s3_requests"] = s3.requests
+    _print_report(result)
+    revision = _revision()
+    output = args.output or path_combine(REPO_PATH, "bench", "results",
+                                         f"soak-{revision}.json")
+    makedirs(dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as file:
+        dump_json({"revision": revision, "parameters": vars(args),
+                   "results": result}, file, indent=2)
+    print(f"Results saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
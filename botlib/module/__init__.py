@@ -1,6 +1,21 @@
 # -*- coding: utf-8 -*-
 # botlib/module/__init__.py
 
-from botlib.module.dev import Dev
-from botlib.module.janken import Janken
-from botlib.module.player import Player
+from importlib import import_module
+
+__all__ = ["Dev", "Janken", "Player"]
+
+# modules are imported on first access, so importing the package stays cheap
+_LAZY_MODULES = {
+    "Dev": "botlib.module.dev",
+    "Janken": "botlib.module.janken",
+    "Player": "botlib.module.player",
+}
+
+
+def __getattr__(name: str):
+    if name not in _LAZY_MODULES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(import_module(_LAZY_MODULES[name]), name)
+    globals()[name] = value
+    return value
@@ -2,23 +2,24 @@
 # botlib/module/dev.py
 
 
-from botlib.sys.config import Config
-from botlib.sys.manager import Locale, StorageManager
-from botlib.sys.util import discord_command, discord_command_wrapper
+from asyncio import to_thread
+from botlib.sys.bus import InvalidationBus
+from botlib.sys.governor import ResourceGovernor
+from botlib.sys.manager import GuildConfigStore, Locale
+from botlib.sys.metrics import Metrics, SamplingProfiler
+from botlib.sys.startup import ready
+from botlib.sys.util import (discord_command, discord_command_wrapper,
+                             help_index)
 from discord.ext.commands import Context
-from os.path import join as path_combine
 
 __all__ = ["Dev", "_get_server_conf"]
 
-_SERVER_CONF_ENTRY = Config.get("SERVER_CONF_ENTRY")
-
 
 async def _get_server_conf(ctx: Context, only_admin: bool = True) -> dict:
-    path = path_combine(_SERVER_CONF_ENTRY, f"{ctx.guild.id}.json")
-    if not StorageManager().exists(path):
+    temp = await (await ready(GuildConfigStore)).fetch(ctx.guild.id)
+    if temp is None:
         await ctx.send("You have not yet registered your server.")
         return {}
-    temp = __import__("json").loads(StorageManager().get(path))
     if str(ctx.author.id) != temp["AdminID"] and only_admin:
         await ctx.send(f"Operation not permitted.")
         return {}
@@ -29,18 +30,19 @@ async def _save_server_conf(ctx: Context, data: dict) -> bool:
     if str(ctx.author.id) != data["AdminID"]:
         await ctx.send(f"Operation not permitted.")
         return False
-    path = path_combine(_SERVER_CONF_ENTRY, f"{ctx.guild.id}.json")
-    if not StorageManager().exists(path):
+    store = await ready(GuildConfigStore)
+    if await store.fetch(ctx.guild.id) is None:
         await ctx.send("You have not yet registered your server.")
         return False
-    StorageManager().put(path, __import__("json").dumps(data))
+    await store.write(ctx.guild.id, data)
     return True
 
 
 @discord_command_wrapper("janken", add_namespace=True)
 class _DevJankenWrap:
     @staticmethod
-    @discord_command("limit")
+    @discord_command("limit", rate_limit={"user": (3, 10.0)},
+                     resources=("s3",))
     async def limit(ctx: Context, operation: str | None = None):
         conf = await _get_server_conf(ctx)
         if not conf:
@@ -68,23 +70,24 @@ class Dev:
         await ctx.send("pong")
 
     @staticmethod
-    @discord_command("register")
+    @discord_command("register", rate_limit={"user": (3, 10.0)},
+                     resources=("s3",))
     async def register(ctx: Context):
-        path = path_combine(_SERVER_CONF_ENTRY, f"{ctx.guild.id}.json")
-        if not StorageManager().exists(path):
-            conf = __import__("json").dumps({
+        store = await ready(GuildConfigStore)
+        if await store.fetch(ctx.guild.id) is None:
+            await store.write(ctx.guild.id, {
                 "AdminID": str(ctx.author.id),
                 "Locale": Locale.NONE.value,
                 "Janken": {"Limit": True}
             })
-            StorageManager().put(path, conf)
             await ctx.send("Registration Complete.")
             await ctx.send(f"User {ctx.author.id} is now administrator.")
         else:
             await ctx.send("Registration has already been completed.")
 
     @staticmethod
-    @discord_command("locale")
+    @discord_command("locale", rate_limit={"user": (3, 10.0)},
+                     resources=("s3",))
     async def locale(ctx: Context, locale: str | None = None):
         conf = await _get_server_conf(ctx)
         if not conf:
@@ -104,6 +107,98 @@ class Dev:
     async def get_all_locales(ctx: Context):
         await ctx.send(", ".join([str(locale.value) for locale in Locale]))
 
-    @property
-    def janken(self) -> _DevJankenWrap:
-        return _DevJankenWrap()
+    @staticmethod
+    @discord_command("help")
+    async def help(ctx: Context):
+        """List every registered command."""
+        await ctx.send("\n".join(help_index()))
+
+    @staticmethod
+    @discord_command("stats")
+    async def stats(ctx: Context):
+        """Show latency, cache and queue metrics."""
+        if not await ctx.bot.is_owner(ctx.author):
+            await ctx.send(f"Operation not permitted.")
+            return
+        metrics = Metrics()
+        lines = []
+        for name in ("holobot_command_seconds", "holobot_storage_seconds",
+                     "holobot_search_seconds", "holobot_recorder_seconds"):
+            histogram = metrics.get(name)
+            if histogram is None:
+                continue
+            for labels in histogram.label_sets():
+                label = ",".join(labels.values())
+                lines.append(f"{name[8:-8]}[{label}] "
+                             f"n={histogram.count(**labels)} "
+                             f"p50<={histogram.quantile(0.5, **labels)}s "
+                             f"p99<={histogram.quantile(0.99, **labels)}s")
+        cache = metrics.counter("holobot_storage_cache_total")
+        lines.append(f"cache hit={cache.value(result='hit'):.0f} "
+                     f"miss={cache.value(result='miss'):.0f}")
+        for name in ("holobot_player_queues", "holobot_player_queued_tracks",
+                     "holobot_voice_clients", "holobot_storage_cache_bytes"):
+            gauge = metrics.get(name)
+            if gauge is not None:
+                lines.append(f"{name[8:]}={gauge.value():.0f}")
+        await ctx.send("```\n" + "\n".join(lines) + "\n```")
+
+    @staticmethod
+    @discord_command("usage")
+    async def usage(ctx: Context):
+        """Show memory, disk cache and per-guild state against limits."""
+        if not await ctx.bot.is_owner(ctx.author):
+            await ctx.send(f"Operation not permitted.")
+            return
+        # the disk cache size may need a directory walk
+        usage = await to_thread(ResourceGovernor().usage)
+        lines = [f"{k}={v}" for k, v in usage]
+        await ctx.send("```\n" + "\n".join(lines) + "\n```")
+
+    @staticmethod
+    @discord_command("profile")
+    async def profile(ctx: Context, operation: str | None = None):
+        """Start or stop the sampling profiler."""
+        if not await ctx.bot.is_owner(ctx.author):
+            await ctx.send(f"Operation not permitted.")
+            return
+        profiler = SamplingProfiler()
+        if operation == "start":
+            profiler.start()
+            await ctx.send("Profiler started.")
+        elif operation == "stop":
+            profiler.stop()
+            report = [f"{share:6.1%} {frame}"
+                      for frame, share in profiler.report()]
+            await ctx.send("```\n" + "\n".join(report)[-1900:] + "\n```")
+        else:
+            await ctx.send(f"Profiler running: {profiler.running}")
+
+    @staticmethod
+    @discord_command("migrate_conf")
+    async def migrate_conf(ctx: Context):
+        """Import every per-guild configure object into the store."""
+        if not await ctx.bot.is_owner(ctx.author):
+            await ctx.send(f"Operation not permitted.")
+            return
+        count = await to_thread(GuildConfigStore().migrate)
+        await ctx.send(f"Migrated {count} server configures.")
+
+    @staticmethod
+    @discord_command("invalidate")
+    async def invalidate(ctx: Context, *ids: str):
+        """Tell every process that catalog entries changed."""
+        if not await ctx.bot.is_owner(ctx.author):
+            await ctx.send(f"Operation not permitted.")
+            return
+        if not ids:
+            await InvalidationBus.get().publish("catalog", all=True)
+        else:
+            tracks = [i for i in ids if len(i) == 4]
+            # a changed track changes the schema of its author as well
+            authors = {i[:2] for i in ids}
+            await InvalidationBus.get().publish(
+                "catalog", authors=sorted(authors), tracks=tracks)
+        await ctx.send("Invalidation published.")
+
+    janken = _DevJankenWrap
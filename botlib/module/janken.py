@@ -1,18 +1,21 @@
 # -*- coding: utf-8 -*-
 # botlib/module/janken.py
 
+from asyncio import to_thread
 from botlib.module.dev import _get_server_conf
 from botlib.sys.config import Config
 from botlib.sys.manager import Locale, LocaleProperties, StorageManager
-from botlib.sys.util import discord_command, discord_command_wrapper
+from botlib.sys.metrics import Metrics
+from botlib.sys.startup import ready
+from botlib.sys.util import (command_router, commands_help, discord_command,
+                             discord_command_wrapper)
 from datetime import datetime
 from discord import Embed, File
 from discord.ext.commands import Context
 from enum import Enum, IntEnum
-from json import loads as loads_json
 from os.path import join as path_combine
 from re import findall as findall_regexp
-from sqlite3 import connect as connect_db
+from threading import Lock
 from uuid import uuid4
 
 __all__ = ["Janken"]
@@ -31,9 +34,16 @@ def _get_command_info() -> dict:
     return {"command_name": base_locale.get("Command"), "alias": alias}
 
 
+_RECORDER_SECONDS = Metrics().histogram("holobot_recorder_seconds",
+                                        "Janken recorder latency")
+_ROUTES = command_router("janken", ("Rock", "Scissors", "Paper", "Record",
+                                    "Help"))
+
+
 def _get_janken_db() -> str:
     key = path_combine(_JANKEN_DATA_ENTRY, "janken.sqlite")
-    return StorageManager().get_to_file(key)
+    # the recorder writes to the file, so it must not be a shared copy
+    return StorageManager().get_to_file(key, writable=True)
 
 
 def _save_janken_db():
@@ -71,6 +81,7 @@ class Record:
 class JankenRecorder:
     _instance = None
     _initialized: bool = False
+    _lock = Lock()
 
     def __new__(cls, *args, **kwargs):
         # single-ton pattern
@@ -79,29 +90,38 @@ class JankenRecorder:
         return cls._instance
 
     def __init__(self):
-        # single-ton
+        # single-ton, may be warmed up from a worker thread
         if self._initialized:
             return
-        self._initialized = True
-        self._db_connect = connect_db(_get_janken_db())
-        self._cursor = self._db_connect.cursor()
+        with self._lock:
+            if self._initialized:
+                return
+            from sqlite3 import connect as connect_db
+            self._db_connect = connect_db(_get_janken_db(),
+                                          check_same_thread=False)
+            self._initialized = True
 
     def write(self, user_id: str, result: JankenResult):
-        self._cursor.execute(
-            "INSERT INTO Records (id, result, date) VALUES (?, ?, ?)",
-            (user_id, result.value, datetime.now().strftime("%Y-%m-%d"))
-        )
-        self._db_connect.commit()
-        _save_janken_db()
+        with _RECORDER_SECONDS.time(operation="write"):
+            self._db_connect.execute(
+                "INSERT INTO Records (id, result, date) VALUES (?, ?, ?)",
+                (user_id, result.value, datetime.now().strftime("%Y-%m-%d"))
+            )
+            self._db_connect.commit()
+            _save_janken_db()
 
     def read_all(self, user_id: str) -> list[Record]:
-        self._cursor.execute(
-            f"SELECT * FROM Records WHERE id={user_id} ORDER BY date DESC"
-        )
-        records = [
-            Record(JankenResult(result), datetime.strptime(date, "%Y-%m-%d"))
-            for _, result, date in self._cursor.fetchall()
-        ]
+        with _RECORDER_SECONDS.time(operation="read"):
+            # a cursor per read, so none outlives its result
+            cursor = self._db_connect.execute(
+                f"SELECT * FROM Records WHERE id={user_id} ORDER BY date DESC"
+            )
+            records = [
+                Record(JankenResult(result),
+                       datetime.strptime(date, "%Y-%m-%d"))
+                for _, result, date in cursor.fetchall()
+            ]
+            cursor.close()
         return records
 
     def read_one(self, user_id: str) -> Record | None:
@@ -113,22 +133,21 @@ class JankenRecorder:
 
 @discord_command_wrapper()
 class Janken:
-    @discord_command(**_get_command_info())
+    @discord_command(**_get_command_info(),
+                     rate_limit={"user": (3, 10.0), "guild": (15, 10.0)},
+                     resources=("s3",))
     async def handler(self, ctx: Context, command: str = "", *args, **kwargs):
         conf = await _get_server_conf(ctx, only_admin=False)
         locale = LocaleProperties("janken", Locale(conf["Locale"]))
-        command = command.lower()
-        match command.lower():
-            case cmd if cmd in eval(locale.get("Command_Rock")):
+        match _ROUTES[locale.current_locale].get(command.lower()):
+            case "Rock":
                 await self.game(ctx, locale, JankenType.Rock)
-            case cmd if cmd in eval(locale.get("Command_Scissors")):
+            case "Scissors":
                 await self.game(ctx, locale, JankenType.Scissors)
-            case cmd if cmd in eval(locale.get("Command_Paper")):
+            case "Paper":
                 await self.game(ctx, locale, JankenType.Paper)
-            case cmd if cmd in eval(locale.get("Command_Record")):
+            case "Record":
                 await self.record(ctx, locale, *args, **kwargs)
-            case cmd if cmd in eval(locale.get("Command_Help")):
-                await self.help(ctx, locale)
             case _:
                 await self.help(ctx, locale)
 
@@ -136,7 +155,8 @@ class Janken:
     async def game(ctx: Context, locale: LocaleProperties, choice: JankenType):
         user_id = str(ctx.author.id)
         conf = await _get_server_conf(ctx, only_admin=False)
-        record = JankenRecorder().read_one(user_id)
+        recorder = await ready(JankenRecorder)
+        record = await to_thread(recorder.read_one, user_id)
         if (record and conf["Janken"]["Limit"] and
                 86400 > (datetime.now() - record.date).total_seconds()):
             await ctx.send(locale.get("Janken_NextDay"))
@@ -146,14 +166,16 @@ class Janken:
                          1: {0: "Lose", 1: "Draw", 2: "Win"},
                          2: {0: "Win", 1: "Lose", 2: "Draw"}}
         result = JankenResult(compare_table[choice][bot_choice])
-        JankenRecorder().write(user_id, result)
+        # the database is uploaded on every write
+        await to_thread(recorder.write, user_id, result)
         key = path_combine(_JANKEN_RESOURCE_ENTRY, f"{bot_choice}/Default.mp4")
-        path = StorageManager().get_to_file(key)
+        path = await to_thread(StorageManager().get_to_file, key)
         await ctx.reply(file=File(path, filename=f"{uuid4()}.mp4"))
 
     @staticmethod
     async def record(ctx: Context, locale: LocaleProperties, query: str = ":5"):
-        records = JankenRecorder().read_all(str(ctx.author.id))
+        recorder = await ready(JankenRecorder)
+        records = await to_thread(recorder.read_all, str(ctx.author.id))
         total = [0, 0, 0]
         for record in records:
             if record.result == JankenResult.Win:
@@ -188,9 +210,4 @@ class Janken:
 
     @staticmethod
     async def help(ctx: Context, locale: LocaleProperties):
-        embed = Embed(title=locale.get("Help_Title"), color=0x82e6e6)
-        descriptions = loads_json(locale.get("Help_Field"))
-        for description in descriptions:
-            description["value"] = "\n".join(description["value"])
-            embed.add_field(**description, inline=False)
-        await ctx.send(embed=embed)
+        await commands_help(ctx, locale)
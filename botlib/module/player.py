@@ -3,26 +3,51 @@
 
 from __future__ import annotations
 from botlib.module.dev import _get_server_conf
+from botlib.sys.bus import InvalidationBus
+from botlib.sys.cache import LRUCache
 from botlib.sys.config import Config
+from botlib.sys.governor import ResourceGovernor
 from botlib.sys.manager import Locale, LocaleProperties, StorageManager
-from botlib.sys.util import (discord_command, discord_command_wrapper,
-                             commands_help)
+from botlib.sys.metrics import Metrics
+from botlib.sys.ratelimit import AdmissionGate
+from botlib.sys.startup import ready
+from botlib.sys.util import (command_router, commands_help, discord_command,
+                             discord_command_wrapper)
+from asyncio import Task, create_task, gather, sleep, to_thread
 from collections import deque as queue
+from collections.abc import Callable
 from discord import Embed, FFmpegOpusAudio
 from discord.ext.commands import Context
-from os import makedirs
+from os import environ, getpid, makedirs, replace
+from os.path import dirname
+from os.path import exists as file_exists
 from os.path import join as path_combine
-from whoosh.analysis import FancyAnalyzer
-from whoosh.fields import ID, Schema, TEXT
-from whoosh.index import create_in
-from whoosh.qparser import MultifieldParser
+from threading import Lock, Timer
+from time import monotonic
 
 __all__ = ["Player"]
 
 _BASE_PATH = Config.get("BASE_PATH")
 _INDEX_PATH = path_combine(_BASE_PATH, Config.get("INDEX_PATH"))
+_CODEC_INDEX_PATH = path_combine(_BASE_PATH, Config.get("CACHE_PATH"),
+                                 "codec-index.json")
 _PLAYER_DATA_ENTRY = Config.get("PLAYER_DATA_ENTRY")
 _PLAYER_RESOURCE_ENTRY = Config.get("PLAYER_RESOURCE_ENTRY")
+_CODEC_SAVE_DELAY = 2.0
+_VOICE_IDLE_TIMEOUT = float(Config.get("VOICE_IDLE_TIMEOUT", "300"))
+# (locale, locale file version, kind, music id) -> rendered embed payload
+_EMBEDS = LRUCache(int(Config.get("EMBED_CACHE_SIZE", "4096")))
+# (locale, author id) -> parsed schema of the author
+_SCHEMAS = LRUCache(256)
+# tracks one play command may enqueue, and upcoming tracks to download
+_BULK_LIMIT = 200
+_PREFETCH_COUNT = 2
+# music id -> resource download in flight, shared by prefetch and playback
+_DOWNLOADS: dict[str, Task] = {}
+# music id -> guilds that asked for its download
+_DOWNLOAD_GUILDS: dict[str, set[int]] = {}
+# guilds where a play command is starting the first track
+_STARTING: set[int] = set()
 
 
 def _get_command_info() -> dict:
@@ -32,6 +57,14 @@ def _get_command_info() -> dict:
     return {"command_name": base_locale.get("Command"), "alias": alias}
 
 
+_SEARCH_SECONDS = Metrics().histogram("holobot_search_seconds",
+                                      "Music search latency")
+_EMBED_REQUESTS = Metrics().counter("holobot_player_embed_cache_total",
+                                    "Rendered embed lookups by result")
+_ROUTES = command_router("player", ("Play", "Leave", "Next", "Search", "Loop",
+                                    "Shuffle", "Queue"))
+
+
 class Music:
     def __init__(self, title: str, authors: str, alias: str, id_: str):
         self._title = title
@@ -47,12 +80,44 @@ class Music:
         music_id = id_[2:4]
         return author_id, music_id
 
+    @staticmethod
+    def get_schema(locale: Locale, author_id: str) -> dict | None:
+        """
+        Get the schema of every music of an author.
+
+        :param locale: locale
+        :param author_id: author id
+        :return: music id -> schema, None if the author does not exist
+        """
+        schema = _SCHEMAS.get((locale, author_id))
+        if schema is None:
+            key = path_combine(_PLAYER_RESOURCE_ENTRY, author_id,
+                               f"schema_{str(locale.value)}.json")
+            try:
+                schema = __import__("json").loads(StorageManager().get(key))
+            except Exception as e:
+                if hasattr(e, "response"):
+                    if e.response["ResponseMetadata"]["HTTPStatusCode"] \
+                            == 404:
+                        return None
+                raise e
+            _SCHEMAS.put((locale, author_id), schema)
+        return schema
+
     @staticmethod
     def create(locale: Locale, id_: str) -> Music:
         author_id, music_id = Music.analyze_id(id_)
-        key = path_combine(_PLAYER_RESOURCE_ENTRY, author_id,
-                           f"schema_{str(locale.value)}.json")
-        schema = __import__("json").loads(StorageManager().get(key))[music_id]
+        schema = Music.get_schema(locale, author_id)
+        if schema is None or music_id not in schema:
+            raise ValueError(f"Music {id_} does not exist.")
+        return Music.from_schema(schema[music_id])
+
+    @staticmethod
+    def from_schema(schema: dict) -> Music:
+        if "codec" in schema:
+            # recorded at ingest, so the first play can skip probing too
+            CodecIndex().record(schema["id"], schema["codec"],
+                                schema.get("bitrate"))
         return Music(schema["title"], ", ".join(schema["authors"]),
                      schema["alias"], schema["id"])
 
@@ -87,7 +152,40 @@ class Music:
         return self._id
 
 
-class MusicSearcher:
+def _is_shared_index() -> bool:
+    # the index is built when the supervisor starts, so a restarted worker
+    # may miss catalog changes made since and builds its own instead
+    return environ.get("HOLOBOT_SHARED_INDEX") == "1" and \
+        environ.get("HOLOBOT_WORKER_RESTARTS", "0") == "0"
+
+
+def prepare_shared_assets():
+    """
+    Download the catalog into the disk cache and build the search index
+    once, so every worker process on the host reads them from disk.
+    """
+    root = path_combine(_PLAYER_RESOURCE_ENTRY, "root.json")
+    StorageManager().get_to_file(root)
+    root_schema = __import__("json").loads(StorageManager().get(root))
+    for author in root_schema["authors"]:
+        for locale in Locale:
+            key = path_combine(_PLAYER_RESOURCE_ENTRY, author,
+                               f"schema_{str(locale.value)}.json")
+            if StorageManager().exists(key):
+                StorageManager().get_to_file(key)
+    environ.pop("HOLOBOT_SHARED_INDEX", None)
+    MusicSearcher()
+    environ["HOLOBOT_SHARED_INDEX"] = "1"
+
+
+class CodecIndex:
+    """
+    A class that remembers the codec and bitrate of every resource.
+    Each resource is probed at most once, on its first play, and the
+    result is kept next to the disk cache for later runs. Changes are
+    saved in batches from a timer thread and merged with the entries
+    other processes saved.
+    """
     _instance = None
     _initialized: bool = False
 
@@ -97,41 +195,216 @@ class MusicSearcher:
             cls._instance = super().__new__(cls)
         return cls._instance
 
-    def __init__(self) -> None:
+    def __init__(self):
         # single-ton
         if self._initialized:
             return
         self._initialized = True
+        self._lock = Lock()
+        # music id -> entry to save, None to remove it
+        self._changes: dict[str, tuple[str | None, int | None] | None] = {}
+        self._timer: Timer | None = None
+        self._codecs = self._load()
+
+    @staticmethod
+    def _load() -> dict[str, tuple[str | None, int | None]]:
+        if not file_exists(_CODEC_INDEX_PATH):
+            return {}
+        with open(_CODEC_INDEX_PATH, encoding="utf-8") as file:
+            data = __import__("json").load(file)
+        return {k: tuple(v) for k, v in data.items()}
+
+    def record(self, id_: str, codec: str | None, bitrate: int | None):
+        with self._lock:
+            if self._codecs.get(id_) == (codec, bitrate):
+                return
+            self._codecs[id_] = (codec, bitrate)
+            self._change(id_, (codec, bitrate))
+
+    def forget(self, id_: str):
+        with self._lock:
+            # another process may have saved it, so remove it regardless
+            self._codecs.pop(id_, None)
+            self._change(id_, None)
+
+    def _change(self, id_: str, entry: tuple | None):
+        # called with the lock held
+        self._changes[id_] = entry
+        if self._timer is None:
+            self._timer = Timer(_CODEC_SAVE_DELAY, self._save)
+            self._timer.start()
+
+    def _save(self):
+        from fcntl import LOCK_EX, flock
+        with self._lock:
+            changes, self._changes = self._changes, {}
+            self._timer = None
+        try:
+            makedirs(dirname(_CODEC_INDEX_PATH), exist_ok=True)
+            # other processes save the index too, so merge under a lock
+            # and replace it atomically for readers
+            with open(f"{_CODEC_INDEX_PATH}.lock", "a") as lock:
+                flock(lock, LOCK_EX)
+                codecs = self._load()
+                for id_, entry in changes.items():
+                    if entry is None:
+                        codecs.pop(id_, None)
+                    else:
+                        codecs[id_] = entry
+                temp = f"{_CODEC_INDEX_PATH}.{getpid()}.tmp"
+                with open(temp, "w", encoding="utf-8") as file:
+                    __import__("json").dump(codecs, file)
+                replace(temp, _CODEC_INDEX_PATH)
+        except Exception as e:
+            print(f"Saving the codec index failed: {e!r}")
+            with self._lock:
+                # saved with the next change
+                for id_, entry in changes.items():
+                    self._changes.setdefault(id_, entry)
+            return
+        with self._lock:
+            # keep what other processes probed, and changes made meanwhile
+            for id_, entry in self._changes.items():
+                if entry is None:
+                    codecs.pop(id_, None)
+                else:
+                    codecs[id_] = entry
+            self._codecs = codecs
+
+    async def get(self, id_: str, path: str) -> tuple[str | None, int | None]:
+        """
+        Get the codec and bitrate of a resource, probing it if unknown.
+        A failed probe is not remembered, so the next play probes again.
+
+        :param id_: music id
+        :param path: resource file path
+        :return: codec, bitrate
+        """
+        entry = self._codecs.get(id_)
+        # entries without a codec were saved by failed probes of old runs
+        if entry is None or entry[0] is None:
+            entry = await FFmpegOpusAudio.probe(path)
+            if entry[0] is not None:
+                self.record(id_, *entry)
+        return tuple(entry)
+
+
+class MusicSearcher:
+    _instance = None
+    _initialized: bool = False
+    _lock = Lock()
+    # serializes rebuilds and in-place updates, searches never wait on it
+    _update_lock = Lock()
+
+    def __new__(cls, *args, **kwargs):
+        # single-ton pattern
+        if not cls._instance:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self) -> None:
+        # single-ton, may be warmed up from a worker thread
+        if self._initialized:
+            return
+        with self._lock:
+            if self._initialized:
+                return
+            self._indexes, self._shared = self._build()
+            self._initialized = True
+
+    def _build(self, rebuild: bool = False) -> tuple[dict, bool]:
+        """
+        Build the indexes of every locale.
+
+        :param rebuild: If True, build in memory instead of on disk
+        :return: locale -> index, whether they are shared with other
+                 processes
+        """
+        # whoosh is only needed once the searcher is built
+        from whoosh.analysis import FancyAnalyzer
+        from whoosh.fields import ID, Schema, TEXT
+        from whoosh.filedb.filestore import RamStorage
+        from whoosh.index import create_in, exists_in, open_dir
         analyzer = FancyAnalyzer()
         self._schema = Schema(
             title=TEXT(analyzer=analyzer, stored=True, field_boost=2),
             authors=TEXT(analyzer=analyzer, stored=True, field_boost=1.5),
             alias=TEXT(analyzer=analyzer, stored=True, field_boost=1.2),
             id_=ID(stored=True, field_boost=0.05))
-        self._indexes = {}
+        indexes, shared = {}, False
         root = path_combine(_PLAYER_RESOURCE_ENTRY, "root.json")
         root_schema = __import__("json").loads(StorageManager().get(root))
         for locale in Locale:
             if locale == Locale.NONE:
                 continue
             index_path = path_combine(_INDEX_PATH, str(locale.value))
-            makedirs(index_path, exist_ok=True)
-            index = create_in(index_path, self._schema)
+            if rebuild:
+                # searches and other workers may still read the files
+                index = RamStorage().create_index(self._schema)
+            elif _is_shared_index() and exists_in(index_path):
+                # built once per host by the shard supervisor
+                indexes[locale] = open_dir(index_path)
+                shared = True
+                continue
+            else:
+                makedirs(index_path, exist_ok=True)
+                index = create_in(index_path, self._schema)
             writer = index.writer()
             for author in root_schema["authors"]:
                 key = path_combine(_PLAYER_RESOURCE_ENTRY, author,
                                    f"schema_{str(locale.value)}.json")
                 schema = __import__("json").loads(StorageManager().get(key))
-                for music in schema.values():
-                    writer.add_document(title=music["title"],
-                                        authors=", ".join(music["authors"]),
-                                        alias=music["alias"],
-                                        id_=music["id"])
+                self._add_all(writer, schema)
             writer.commit()
-            self._indexes[locale] = index
+            indexes[locale] = index
+        return indexes, shared
+
+    @staticmethod
+    def _add_all(writer, schema: dict):
+        for music in schema.values():
+            writer.add_document(title=music["title"],
+                                authors=", ".join(music["authors"]),
+                                alias=music["alias"],
+                                id_=music["id"])
+
+    def refresh(self):
+        """
+        Rebuild the indexes from the current catalog and swap them in.
+        """
+        with self._update_lock:
+            self._swap(*self._build(rebuild=True))
+
+    def _swap(self, indexes: dict, shared: bool):
+        with self._lock:
+            self._indexes, self._shared = indexes, shared
+
+    def update(self, authors: list[str]):
+        """
+        Re-index the music of some authors in place, so catalog changes
+        cost as much as the changed authors rather than the catalog.
+        Indexes shared with other processes are rebuilt privately instead.
+
+        :param authors: author ids whose schemas changed
+        """
+        from whoosh.query import Prefix
+        with self._update_lock:
+            if self._shared:
+                self._swap(*self._build(rebuild=True))
+                return
+            for locale, index in self._indexes.items():
+                writer = index.writer()
+                for author in authors:
+                    # music ids start with the author id
+                    writer.delete_by_query(Prefix("id_", author))
+                    schema = Music.get_schema(locale, author)
+                    if schema is not None:
+                        self._add_all(writer, schema)
+                writer.commit()
 
     def search(self, request: str, locale: Locale) -> list[Music]:
-        with self._indexes[locale].searcher() as searcher:
+        from whoosh.qparser import MultifieldParser
+        with (_SEARCH_SECONDS.time(locale=locale.value),
+              self._indexes[locale].searcher() as searcher):
             parser = MultifieldParser(
                 ["title", "authors", "alias", "id_"],
                 self._schema
@@ -163,12 +436,15 @@ class MusicQueue:
         self._is_loop: dict[int, bool] = {}
 
     def add(self, ctx, source):
+        self.extend(ctx, (source,))
+
+    def extend(self, ctx, sources):
         id_ = ctx.guild.id
         if id_ not in self._queue:
             self._queue[id_] = queue()
             self._latest[id_] = None
             self._is_loop[id_] = False
-        self._queue[id_].append(source)
+        self._queue[id_].extend(sources)
 
     def peek(self, ctx):
         id_ = ctx.guild.id
@@ -227,64 +503,397 @@ class MusicQueue:
         return not len(self._queue[id_]) > 0
 
     def free(self, ctx):
-        id_ = ctx.guild.id
-        if id_ in self._queue:
-            del self._queue[id_]
-            del self._latest[id_]
-            del self._is_loop[id_]
+        self.discard(ctx.guild.id)
+
+    def discard(self, guild_id: int):
+        if guild_id in self._queue:
+            del self._queue[guild_id]
+            del self._latest[guild_id]
+            del self._is_loop[guild_id]
+
+    def guild_count(self) -> int:
+        return len(self._queue)
+
+    def pending(self, guild_id: int) -> int:
+        return len(self._queue.get(guild_id, ()))
+
+    def total_length(self) -> int:
+        return sum(len(i) for i in self._queue.values())
+
+
+class VoiceSessions:
+    """
+    A class that reuses voice connections and reclaims idle ones.
+    A guild is idle when nothing is playing or queued, or no one else is
+    listening.
+    """
+    _instance = None
+    _initialized: bool = False
+
+    def __new__(cls, *args, **kwargs):
+        # single-ton pattern
+        if not cls._instance:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        # single-ton
+        if self._initialized:
+            return
+        self._initialized = True
+        self._guilds: dict[int, object] = {}
+        self._idle_since: dict[int, float] = {}
+        self._reclaimers: list[Callable[[int], None]] = [
+            MusicQueue().discard]
+        self._reaper: Task | None = None
+
+    def on_reclaim(self, callback: Callable[[int], None]):
+        """
+        Register a callback that frees per-guild state.
+
+        :param callback: called with the guild id
+        """
+        self._reclaimers.append(callback)
+
+    async def connect(self, ctx: Context, channel):
+        """
+        Get a voice client in the channel.
+        An existing connection is moved instead of reconnected.
+
+        :param ctx: context
+        :param channel: voice channel
+        :return: voice client
+        """
+        voice = ctx.guild.voice_client
+        if voice is not None and voice.is_connected():
+            if voice.channel != channel:
+                await voice.move_to(channel)
+        else:
+            if voice is not None:
+                await voice.disconnect(force=True)
+            voice = await channel.connect()
+        self._guilds[ctx.guild.id] = ctx.guild
+        self._idle_since.pop(ctx.guild.id, None)
+        if self._reaper is None or self._reaper.done():
+            self._reaper = create_task(self._reap())
+        return voice
+
+    async def release(self, guild):
+        """
+        Disconnect from a guild and reclaim its state.
+
+        :param guild: guild
+        """
+        if guild.voice_client is not None:
+            await guild.voice_client.disconnect(force=True)
+        self._reclaim(guild.id)
+
+    def _reclaim(self, guild_id: int):
+        self._guilds.pop(guild_id, None)
+        self._idle_since.pop(guild_id, None)
+        for reclaimer in self._reclaimers:
+            try:
+                reclaimer(guild_id)
+            except Exception as e:
+                print(f"Reclaimer of {guild_id} failed: {e!r}")
+
+    @staticmethod
+    def _is_idle(guild_id: int, voice) -> bool:
+        if not [i for i in voice.channel.members if not i.bot]:
+            return True
+        # between tracks or while the next one downloads is not idle
+        return (not voice.is_playing() and not voice.is_paused() and
+                not MusicQueue().pending(guild_id))
+
+    async def _reap(self):
+        while self._guilds:
+            await sleep(max(min(_VOICE_IDLE_TIMEOUT / 2, 30.0), 1.0))
+            now = monotonic()
+            for guild_id, guild in list(self._guilds.items()):
+                # one failing guild must not stop the reaper for the others
+                try:
+                    await self._reap_guild(guild_id, guild, now)
+                except Exception as e:
+                    print(f"Voice session reclaim of {guild_id} failed: "
+                          f"{e!r}")
+
+    async def _reap_guild(self, guild_id: int, guild, now: float):
+        voice = guild.voice_client
+        if voice is None or not voice.is_connected():
+            # kicked or disconnected elsewhere
+            self._reclaim(guild_id)
+        elif not self._is_idle(guild_id, voice):
+            self._idle_since.pop(guild_id, None)
+        elif guild_id not in self._idle_since:
+            self._idle_since[guild_id] = now
+        elif now - self._idle_since[guild_id] >= _VOICE_IDLE_TIMEOUT:
+            await self.release(guild)
+
+    def session_count(self) -> int:
+        return len(self._guilds)
+
+
+Metrics().gauge("holobot_player_queued_tracks", "Tracks in every queue",
+                lambda: MusicQueue().total_length())
+Metrics().gauge("holobot_player_queues", "Guilds with a queue",
+                lambda: MusicQueue().guild_count())
+Metrics().gauge("holobot_player_voice_sessions", "Tracked voice sessions",
+                lambda: VoiceSessions().session_count())
+
+
+def invalidate_catalog(authors: list[str] | None = None,
+                       tracks: list[str] = ()):
+    """
+    Forget everything cached from the catalog, after it changed.
+    Resources are large, so only the listed tracks are downloaded again.
+
+    :param authors: author ids whose schemas changed, every author if None
+    :param tracks: music ids whose resources changed
+    """
+    _EMBEDS.clear()
+    _SCHEMAS.clear()
+    root = path_combine(_PLAYER_RESOURCE_ENTRY, "root.json")
+    StorageManager().discard_cache(root)
+    if authors is None:
+        authors = __import__("json").loads(
+            StorageManager().get(root))["authors"]
+    for author in authors:
+        for locale in Locale:
+            StorageManager().discard_cache(path_combine(
+                _PLAYER_RESOURCE_ENTRY, author,
+                f"schema_{str(locale.value)}.json"))
+    for id_ in tracks:
+        author_id, music_id = Music.analyze_id(id_)
+        StorageManager().discard_cache(path_combine(
+            _PLAYER_RESOURCE_ENTRY, f"{author_id}/{music_id}/resource.webm"))
+        CodecIndex().forget(id_)
+
+
+async def _on_catalog(message: dict):
+    authors = message.get("authors", [])
+    if message.get("all"):
+        await to_thread(invalidate_catalog)
+    else:
+        await to_thread(invalidate_catalog, authors,
+                        message.get("tracks", []))
+    searcher = MusicSearcher._instance
+    # a searcher that is not built yet reads the current catalog anyway
+    if searcher is None or not searcher._initialized:
+        return
+    if message.get("all"):
+        await to_thread(searcher.refresh)
+    else:
+        await to_thread(searcher.update, authors)
+
+
+InvalidationBus.get().subscribe("catalog", _on_catalog)
+
+ResourceGovernor().on_guild_gone(MusicQueue().discard)
+ResourceGovernor().on_pressure(_EMBEDS.clear)
+ResourceGovernor().on_pressure(_SCHEMAS.clear)
+ResourceGovernor().count("queues", MusicQueue().guild_count)
+ResourceGovernor().count("voice sessions", VoiceSessions().session_count)
+ResourceGovernor().count("rendered embeds", lambda: len(_EMBEDS))
+
+
+def _load_playlist(guild_id: int, name: str) -> list[str] | None:
+    # names become part of the key, so keep them to a safe alphabet
+    if not all(i.isalnum() or i in "-_" for i in name):
+        return None
+    key = path_combine(_PLAYER_DATA_ENTRY, "playlist", str(guild_id),
+                       f"{name}.json")
+    try:
+        return __import__("json").loads(StorageManager().get(key))["tracks"]
+    except Exception as e:
+        if hasattr(e, "response"):
+            if e.response["ResponseMetadata"]["HTTPStatusCode"] == 404:
+                return None
+        raise e
+
+
+async def _resolve(guild_id: int, locale: Locale, ids: tuple[str, ...]) \
+        -> tuple[list[Music], list[str], int]:
+    """
+    Resolve music ids, author ids and playlist names into musics.
+    Playlists and schemas are each fetched once, concurrently.
+
+    :param guild_id: guild id, playlists are saved per guild
+    :param locale: locale
+    :param ids: 4 letters for a music, 2 for every music of an author,
+                anything else for a saved playlist
+    :return: musics in the requested order, ids that were not found,
+             how many musics were dropped over the bulk limit
+    """
+    names = [i for i in ids if len(i) not in (2, 4)]
+    playlists = dict(zip(names, await gather(
+        *(to_thread(_load_playlist, guild_id, i) for i in names))))
+    requested, invalid = [], []
+    for id_ in ids:
+        if id_ not in playlists:
+            requested.append(id_)
+        elif playlists[id_] is None:
+            invalid.append(id_)
+        else:
+            requested.extend(playlists[id_])
+    authors = list({i[:2] for i in requested if len(i) in (2, 4)})
+    schemas = dict(zip(authors, await gather(
+        *(to_thread(Music.get_schema, locale, i) for i in authors))))
+    musics = []
+    for id_ in requested:
+        schema = schemas.get(id_[:2]) if len(id_) in (2, 4) else None
+        if schema is None or (len(id_) == 4 and id_[2:] not in schema):
+            invalid.append(id_)
+        elif len(id_) == 2:
+            musics.extend(Music.from_schema(schema[i]) for i in sorted(schema))
+        else:
+            musics.append(Music.from_schema(schema[id_[2:]]))
+    return musics[:_BULK_LIMIT], invalid, max(len(musics) - _BULK_LIMIT, 0)
+
+
+def _report_download(task: Task):
+    if not task.cancelled() and task.exception() is not None:
+        print(f"Download failed: {task.exception()!r}")
+
+
+async def _download(id_: str) -> str:
+    try:
+        return await to_thread(Music.get_resource, id_)
+    finally:
+        _DOWNLOADS.pop(id_, None)
+        _DOWNLOAD_GUILDS.pop(id_, None)
+
+
+def _fetch_resource(id_: str, guild_id: int) -> Task:
+    """
+    Download a resource into the disk cache, once however often asked.
+
+    :param id_: music id
+    :param guild_id: guild that needs it
+    :return: task resolving to the file path
+    """
+    if id_ not in _DOWNLOADS:
+        _DOWNLOADS[id_] = create_task(_download(id_))
+        _DOWNLOADS[id_].add_done_callback(_report_download)
+    _DOWNLOAD_GUILDS.setdefault(id_, set()).add(guild_id)
+    return _DOWNLOADS[id_]
+
+
+def _prefetch(ctx):
+    for music in list(MusicQueue().all(ctx))[:_PREFETCH_COUNT]:
+        _fetch_resource(music.id, ctx.guild.id)
+
+
+def _cancel_downloads(guild_id: int):
+    """
+    Cancel the downloads only a reclaimed guild was waiting for.
+    One already running in a worker thread still finishes there.
+
+    :param guild_id: guild id
+    """
+    for id_, guilds in list(_DOWNLOAD_GUILDS.items()):
+        guilds.discard(guild_id)
+        if not guilds:
+            # a task cancelled before it ran never reaches its finally
+            del _DOWNLOAD_GUILDS[id_]
+            task = _DOWNLOADS.pop(id_, None)
+            if task is not None:
+                task.cancel()
+
+
+VoiceSessions().on_reclaim(_cancel_downloads)
+
+
+def _track_embed(locale: LocaleProperties, kind: str, music: Music) -> Embed:
+    # the file version retires entries rendered from an older locale file
+    key = (locale.current_locale, locale.version, kind, music.id)
+    payload = _EMBEDS.get(key)
+    _EMBED_REQUESTS.inc(result="miss" if payload is None else "hit")
+    if payload is None:
+        authors = music.authors[0]
+        if len(music.authors) > 1:
+            others = len(music.authors) - 1
+            authors += locale.get(f"{kind}_Else").format(others)
+        field = locale.get(f"{kind}_Field").format(authors, music.id)
+        embed = Embed(title=music.title, description=field, color=0x82e6e6)
+        embed.set_thumbnail(url=Music.get_thumbnail_url(music.id))
+        payload = embed.to_dict()
+        _EMBEDS.put(key, payload)
+    return Embed.from_dict(payload)
+
+
+def _render_page(locale: LocaleProperties, kind: str, title: str,
+                 subtitle: str, musics: list[Music]) -> list[Embed]:
+    embeds = [Embed(title=title, description=subtitle, color=0x82e6e6)]
+    embeds.extend(_track_embed(locale, kind, music) for music in musics)
+    return embeds
 
 
 @discord_command_wrapper()
 class Player:
-    @discord_command(**_get_command_info())
+    @discord_command(**_get_command_info(),
+                     rate_limit={"user": (5, 10.0), "guild": (20, 10.0)},
+                     resources=("s3",))
     async def handler(self, ctx: Context, command: str = "", *args, **kwargs):
         conf = await _get_server_conf(ctx, only_admin=False)
         locale = LocaleProperties("player", Locale(conf["Locale"]))
-        command = command.lower()
-        match command.lower():
-            case cmd if cmd in eval(locale.get("Command_Play")):
+        match _ROUTES[locale.current_locale].get(command.lower()):
+            case "Play":
                 await self.play(ctx, locale, *args, **kwargs)
-            case cmd if cmd in eval(locale.get("Command_Leave")):
+            case "Leave":
                 await self.leave(ctx)
-            case cmd if cmd in eval(locale.get("Command_Next")):
+            case "Next":
                 await self.next(ctx, locale)
-            case cmd if cmd in eval(locale.get("Command_Search")):
+            case "Search":
                 await self.search(ctx, locale, *args, **kwargs)
-            case cmd if cmd in eval(locale.get("Command_Loop")):
+            case "Loop":
                 await self.loop(ctx, locale)
-            case cmd if cmd in eval(locale.get("Command_Shuffle")):
+            case "Shuffle":
                 await self.shuffle(ctx, locale)
-            case cmd if cmd in eval(locale.get("Command_Queue")):
-                await self.queue(ctx, locale)
+            case "Queue":
+                await self.queue(ctx, locale, *args, **kwargs)
             case _:
                 await commands_help(ctx, locale)
 
     @staticmethod
-    async def play(ctx: Context, locale: LocaleProperties, id_: str):
-        if ctx.author.voice and ctx.author.voice.channel:
-            channel = ctx.author.voice.channel
-            if not ctx.voice_client or not channel == ctx.voice_client.channel:
-                if ctx.guild.voice_client:
-                    await ctx.guild.voice_client.disconnect(force=True)
-                    print("disconnected")
-                await channel.connect()  # noqa
-            voice = ctx.voice_client
-        else:
+    async def play(ctx: Context, locale: LocaleProperties, *ids: str):
+        if not ids:
+            await commands_help(ctx, locale)
+            return
+        if not (ctx.author.voice and ctx.author.voice.channel):
             await ctx.send(locale.get("Play_JoinVoiceChannelFirst"))
             return
-        try:
-            music = Music.create(locale.current_locale, id_)
-            MusicQueue().add(ctx, music)
-            if not voice.is_playing():
+        musics, invalid, dropped = await _resolve(ctx.guild.id,
+                                                  locale.current_locale, ids)
+        if invalid:
+            await ctx.send(locale.get("Play_InvalidID").format(
+                ", ".join(invalid)))
+        if dropped:
+            await ctx.send(locale.get("Play_Truncated").format(
+                dropped, _BULK_LIMIT))
+        if not musics:
+            return
+        voice = await VoiceSessions().connect(ctx, ctx.author.voice.channel)
+        # extended in one step, so no other command sees half of the list
+        MusicQueue().extend(ctx, musics)
+        _prefetch(ctx)
+        if len(musics) > 1:
+            title = locale.get("Play_AddQueue")
+            subtitle = locale.get("Play_AddQueue_Subtitle").format(
+                len(musics), len(MusicQueue().all(ctx)))
+            await ctx.send(embeds=_render_page(locale, "Queue", title,
+                                               subtitle, musics[:9]))
+        # a play command still starting the first track is not playing yet
+        if not voice.is_playing() and ctx.guild.id not in _STARTING:
+            _STARTING.add(ctx.guild.id)
+            try:
                 await Player._play_next(ctx, locale)
-            else:
-                embed = Embed(title=locale.get("Play_AddQueue"),
-                              description=music.title, color=0x82e6e6)
-                embed.set_thumbnail(url=Music.get_thumbnail_url(music.id))
-                await ctx.send(embed=embed)
-        except ValueError as e:
-            print(e)
-            await ctx.send(locale.get("Play_InvalidID").format(id_))
+            finally:
+                _STARTING.discard(ctx.guild.id)
+        elif len(musics) == 1:
+            embed = Embed(title=locale.get("Play_AddQueue"),
+                          description=musics[0].title, color=0x82e6e6)
+            embed.set_thumbnail(url=Music.get_thumbnail_url(musics[0].id))
+            await ctx.send(embed=embed)
 
     @staticmethod
     async def _play_next(ctx, locale: LocaleProperties, pop: bool = False):
@@ -292,8 +901,13 @@ class Player:
             if pop:
                 MusicQueue().pop(ctx)
             music = MusicQueue().peek(ctx)
-            path = Music.get_resource(music.id)
-            source = await FFmpegOpusAudio.from_probe(path)
+            path = await _fetch_resource(music.id, ctx.guild.id)
+            _prefetch(ctx)
+            # queued tracks must still start, so wait instead of rejecting
+            async with AdmissionGate.get("ffmpeg").slot(ctx.guild.id, False):
+                codec, bitrate = await CodecIndex().get(music.id, path)
+            # an opus codec makes FFmpeg copy the stream without re-encoding
+            source = FFmpegOpusAudio(path, codec=codec, bitrate=bitrate)
             voice = ctx.voice_client
             voice.play(source, after=lambda e: (
                 print(e), ctx.bot.loop.create_task(
@@ -306,8 +920,7 @@ class Player:
     @staticmethod
     async def leave(ctx: Context):
         if ctx.guild.voice_client:
-            await ctx.guild.voice_client.disconnect(force=True)
-            MusicQueue().free(ctx)
+            await VoiceSessions().release(ctx.guild)
 
     @staticmethod
     async def next(ctx: Context, locale: LocaleProperties):
@@ -317,19 +930,12 @@ class Player:
     async def search(ctx: Context, locale: LocaleProperties,
                      query: str, page_: str = "1"):
         page = int(page_)
-        hits = MusicSearcher().search(query, locale.current_locale)
-        embeds = []
+        searcher = await ready(MusicSearcher)
+        hits = searcher.search(query, locale.current_locale)
         title = locale.get("Search_Title").format(query)
         subtitle = locale.get("Search_Subtitle").format(len(hits), page)
-        embeds.append(Embed(title=title, description=subtitle, color=0x82e6e6))
-        for hit in hits[9 * (page - 1):9 * page]:
-            author = hit.authors[0]
-            if len(hit.authors) > 1:
-                author += locale.get("Search_Else").format(len(hit.authors) - 1)
-            field = locale.get("Search_Field").format(author, hit.id)
-            embed = Embed(title=hit.title, description=field, color=0x82e6e6)
-            embed.set_thumbnail(url=Music.get_thumbnail_url(hit.id))
-            embeds.append(embed)
+        embeds = _render_page(locale, "Search", title, subtitle,
+                              hits[9 * (page - 1):9 * page])
         await ctx.send(embeds=embeds)
 
     @staticmethod
@@ -348,19 +954,10 @@ class Player:
             await ctx.send(locale.get("Queue_NotExist"))
             return
         MusicQueue().shuffle(ctx)
-        musics = list(map(lambda x: x, MusicQueue().all(ctx)))[:9]
-        embeds = []
+        musics = list(MusicQueue().all(ctx))
         title = locale.get("Queue_Title")
-        subtitle = locale.get("Queue_Subtitle").format(len(musics))
-        embeds.append(Embed(title=title, description=subtitle, color=0x82e6e6))
-        for music in musics:
-            authors = music.authors[0]
-            if len(music.authors) > 1:
-                authors += locale.get("Queue_Else").format(len(authors) - 1)
-            field = locale.get("Queue_Field").format(authors, music.id)
-            embed = Embed(title=music.title, description=field, color=0x82e6e6)
-            embed.set_thumbnail(url=Music.get_thumbnail_url(music.id))
-            embeds.append(embed)
+        subtitle = locale.get("Queue_Subtitle").format(len(musics), 1)
+        embeds = _render_page(locale, "Queue", title, subtitle, musics[:9])
         await ctx.send(embeds=embeds)
         await Player._play_next(ctx, locale)
 
@@ -370,17 +967,9 @@ class Player:
             await ctx.send(locale.get("Queue_NotExist"))
             return
         page = int(page_)
-        musics = list(map(lambda x: x, MusicQueue().all(ctx)))
-        embeds = []
+        musics = list(MusicQueue().all(ctx))
         title = locale.get("Queue_Title")
         subtitle = locale.get("Queue_Subtitle").format(len(musics), page)
-        embeds.append(Embed(title=title, description=subtitle, color=0x82e6e6))
-        for music in musics[9 * (page - 1):9 * page]:
-            authors = music.authors[0]
-            if len(music.authors) > 1:
-                authors += locale.get("Queue_Else").format(len(authors) - 1)
-            field = locale.get("Queue_Field").format(authors, music.id)
-            embed = Embed(title=music.title, description=field, color=0x82e6e6)
-            embed.set_thumbnail(url=Music.get_thumbnail_url(music.id))
-            embeds.append(embed)
+        embeds = _render_page(locale, "Queue", title, subtitle,
+                              musics[9 * (page - 1):9 * page])
         await ctx.send(embeds=embeds)
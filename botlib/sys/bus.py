@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+# botlib/sys/bus.py
+
+from abc import ABC, abstractmethod
+from asyncio import (Lock, Task, create_task, open_connection, sleep,
+                     wait_for)
+from botlib.sys.config import Config
+from collections.abc import Awaitable, Callable
+from json import dumps as dumps_json
+from json import loads as loads_json
+from os import getpid
+from socket import gethostname
+from urllib.parse import urlsplit
+
+__all__ = ["InvalidationBus", "LocalBus", "RedisBus", "encode_command",
+           "read_reply"]
+
+_BACKEND = Config.get("BUS_BACKEND", "local")
+_URL = Config.get("BUS_URL", "redis://127.0.0.1:6379/0")
+_CHANNEL = Config.get("BUS_CHANNEL", "holobot.invalidate")
+_MAX_BACKOFF = 30.0
+_TIMEOUT = 5.0
+
+Handler = Callable[[dict], Awaitable[None]]
+
+
+def encode_command(*args: str | bytes) -> bytes:
+    """
+    Encode a command in the Redis serialization protocol.
+
+    :param args: command and arguments
+    :return: request bytes
+    """
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if isinstance(arg, str):
+            arg = arg.encode("utf-8")
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+
+async def read_reply(reader):
+    """
+    Read one reply in the Redis serialization protocol.
+
+    :param reader: stream reader
+    :return: str, int, bytes, list or None
+    :raise ConnectionError: If the connection was closed
+    :raise RuntimeError: If the reply is an error
+    """
+    line = await reader.readline()
+    if not line.endswith(b"\r\n"):
+        raise ConnectionError("Connection closed.")
+    kind, rest = line[:1], line[1:-2]
+    match kind:
+        case b"+":
+            return rest.decode("utf-8")
+        case b"-":
+            raise RuntimeError(rest.decode("utf-8"))
+        case b":":
+            return int(rest)
+        case b"$":
+            if int(rest) < 0:
+                return None
+            return (await reader.readexactly(int(rest) + 2))[:-2]
+        case b"*":
+            if int(rest) < 0:
+                return None
+            return [await read_reply(reader) for _ in range(int(rest))]
+    raise RuntimeError(f"Unknown reply {line!r}.")
+
+
+class InvalidationBus(ABC):
+    """
+    A channel that tells every bot process which cached data changed.
+    Messages are delivered to the publishing process too, and carry the
+    node that sent them so a handler can skip its own changes.
+    A message with "all" set means deliveries may have been missed and
+    every cached entry of the topic should be dropped.
+    """
+    _instance = None
+
+    def __init__(self):
+        self._handlers: dict[str, list[Handler]] = {}
+        self.node = f"{gethostname()}:{getpid()}"
+
+    @staticmethod
+    def get() -> "InvalidationBus":
+        """
+        Get the bus of the process, as configured by BUS_BACKEND.
+
+        :return: bus
+        """
+        if InvalidationBus._instance is None:
+            InvalidationBus._instance = RedisBus(_URL, _CHANNEL) \
+                if _BACKEND == "redis" else LocalBus()
+        return InvalidationBus._instance
+
+    def subscribe(self, topic: str, handler: Handler):
+        """
+        Register a handler for the messages of a topic.
+
+        :param topic: topic, e.g. "guildconf" or "catalog"
+        :param handler: coroutine function called with the message
+        """
+        self._handlers.setdefault(topic, []).append(handler)
+
+    async def _deliver(self, message: dict):
+        for handler in self._handlers.get(message.get("topic"), []):
+            try:
+                await handler(message)
+            except Exception as e:
+                print(f"Invalidation handler failed: {e!r}")
+
+    async def _resync(self):
+        for topic in list(self._handlers):
+            await self._deliver({"topic": topic, "origin": "", "all": True})
+
+    async def start(self):
+        """
+        Start receiving messages.
+        """
+
+    @abstractmethod
+    async def publish(self, topic: str, **payload):
+        """
+        Broadcast a message to every process.
+
+        :param topic: topic
+        :param payload: JSON serializable fields of the message
+        """
+
+
+class LocalBus(InvalidationBus):
+    """
+    A bus that only reaches the handlers of this process.
+    """
+
+    async def publish(self, topic: str, **payload):
+        await self._deliver({"topic": topic, "origin": self.node, **payload})
+
+
+class RedisBus(InvalidationBus):
+    """
+    A bus on a Redis pub/sub channel, or anything speaking the protocol.
+    Publishing is best-effort, and after a lost connection every topic
+    gets an "all" message because deliveries may have been missed.
+    """
+
+    def __init__(self, url: str, channel: str):
+        """
+        :param url: redis://[:password@]host[:port][/db]
+        :param channel: pub/sub channel shared by every process
+        """
+        super().__init__()
+        parts = urlsplit(url)
+        self._host = parts.hostname or "127.0.0.1"
+        self._port = parts.port or 6379
+        self._password = parts.password
+        self._channel = channel
+        self._listener: Task | None = None
+        self._writer = None
+        self._reader = None
+        self._publish_lock = Lock()
+
+    async def _connect(self):
+        reader, writer = await wait_for(
+            open_connection(self._host, self._port), _TIMEOUT)
+        if self._password:
+            writer.write(encode_command("AUTH", self._password))
+            await read_reply(reader)
+        return reader, writer
+
+    async def start(self):
+        if self._listener is None or self._listener.done():
+            self._listener = create_task(self._listen())
+
+    async def _listen(self):
+        backoff, connected = 1.0, False
+        while True:
+            writer = None
+            try:
+                reader, writer = await self._connect()
+                writer.write(encode_command("SUBSCRIBE", self._channel))
+                await read_reply(reader)
+                backoff = 1.0
+                if connected:
+                    await self._resync()
+                connected = True
+                while True:
+                    reply = await read_reply(reader)
+                    if isinstance(reply, list) and reply[0] == b"message":
+                        await self._deliver(loads_json(reply[2]))
+            except Exception as e:
+                print(f"Invalidation bus disconnected: {e!r}")
+            finally:
+                if writer is not None:
+                    writer.close()
+            await sleep(backoff)
+            backoff = min(backoff * 2, _MAX_BACKOFF)
+
+    async def publish(self, topic: str, **payload):
+        message = dumps_json({"topic": topic, "origin": self.node,
+                              **payload})
+        async with self._publish_lock:
+            # one retry covers a connection that went stale while idle
+            for _ in range(2):
+                try:
+                    if self._writer is None:
+                        self._reader, self._writer = await self._connect()
+                    self._writer.write(
+                        encode_command("PUBLISH", self._channel, message))
+                    await wait_for(read_reply(self._reader), _TIMEOUT)
+                    return
+                except Exception as e:
+                    if self._writer is not None:
+                        self._writer.close()
+                    self._reader, self._writer = None, None
+                    error = e
+            print(f"Invalidation of {topic} was not published: {error!r}")
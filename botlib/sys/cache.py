@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# botlib/sys/cache.py
+
+from collections import OrderedDict
+from collections.abc import Hashable
+from threading import Lock
+
+__all__ = ["LRUCache"]
+
+
+class LRUCache:
+    """
+    A size-bounded mapping that evicts the least recently used entry.
+    """
+
+    def __init__(self, maxsize: int):
+        self._maxsize = maxsize
+        self._data: OrderedDict = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default=None):
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key: Hashable, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
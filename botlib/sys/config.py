@@ -24,8 +24,18 @@ if not exists(SYSTEM_CONFIG_PATH):
 
 
 class Config:
+    _properties: Properties | None = None
+
+    @staticmethod
+    def get(config: str, default: str | None = None) -> str:
+        if Config._properties is None:
+            Config.reload()
+        if default is not None and config not in Config._properties.keys():
+            return default
+        return Config._properties[config]
+
     @staticmethod
-    def get(config: str) -> str:
+    def reload():
         prop = Properties()
         prop.load(SYSTEM_CONFIG_PATH)
-        return prop[config]
+        Config._properties = prop
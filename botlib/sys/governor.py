@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+# botlib/sys/governor.py
+
+from asyncio import sleep, to_thread
+from botlib.sys.config import Config
+from botlib.sys.manager import (GuildConfigStore, StorageManager,
+                                forget_locale, locale_count)
+from collections.abc import Callable
+from gc import collect as collect_garbage
+from os import sysconf
+from time import monotonic
+
+__all__ = ["ResourceGovernor", "activity_middleware", "gateway_options",
+           "memory_usage"]
+
+_LEAN_MODE = Config.get("LEAN_MODE", "false").lower() == "true"
+_MEMORY_LIMIT = int(Config.get("MEMORY_LIMIT_MB", "0")) * 1024 * 1024
+_CACHE_LIMIT = int(Config.get("CACHE_LIMIT_MB", "0")) * 1024 * 1024
+_INTERVAL = float(Config.get("GOVERNOR_INTERVAL", "60"))
+_IDLE_GUILD_TIMEOUT = float(Config.get("IDLE_GUILD_TIMEOUT", "3600"))
+
+
+def gateway_options() -> dict:
+    """
+    Bot options for the gateway intents and the member cache.
+    In lean mode only the events the modules use are received, and only
+    members in voice channels are cached.
+
+    :return: keyword arguments for the bot
+    """
+    from discord import Intents, MemberCacheFlags
+    if not _LEAN_MODE:
+        return {"intents": Intents().all()}
+    intents = Intents.none()
+    intents.guilds = True
+    intents.guild_messages = True
+    intents.message_content = True
+    intents.voice_states = True
+    return {"intents": intents,
+            "member_cache_flags": MemberCacheFlags.from_intents(intents),
+            "chunk_guilds_at_startup": False, "max_messages": None}
+
+
+def memory_usage() -> int:
+    """
+    Get the resident set size of the process.
+
+    :return: bytes
+    """
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # peak instead of current, where procfs is missing
+        from resource import RUSAGE_SELF, getrusage
+        return getrusage(RUSAGE_SELF).ru_maxrss * 1024
+
+
+class ResourceGovernor:
+    """
+    A class that bounds what the process keeps over a long uptime.
+    State of guilds the bot left or that were idle for a while is freed,
+    caches are shed above the memory limit and the disk cache is trimmed
+    to its limit.
+    """
+    _instance = None
+    _initialized: bool = False
+
+    def __new__(cls, *args, **kwargs):
+        # single-ton pattern
+        if not cls._instance:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        # single-ton
+        if self._initialized:
+            return
+        self._initialized = True
+        self._last_seen: dict[int, float] = {}
+        # the store is built on first use, which may read from S3
+        self._reclaimers: list[Callable[[int], None]] = [
+            lambda guild_id: GuildConfigStore().evict(guild_id),
+            forget_locale]
+        self._shedders: list[Callable[[], None]] = [
+            lambda: GuildConfigStore().evict()]
+        self._counters: dict[str, Callable[[], int]] = {
+            "guild configures": lambda: GuildConfigStore().guild_count(),
+            "guild locales": locale_count,
+            "active guilds": lambda: len(self._last_seen)}
+
+    def on_guild_gone(self, callback: Callable[[int], None]):
+        """
+        Register a callback that frees per-guild state.
+
+        :param callback: called with the guild id
+        """
+        self._reclaimers.append(callback)
+
+    def on_pressure(self, callback: Callable[[], None]):
+        """
+        Register a callback that empties a cache above the memory limit.
+
+        :param callback: called without arguments
+        """
+        self._shedders.append(callback)
+
+    def count(self, name: str, callback: Callable[[], int]):
+        """
+        Register a size shown in the usage report.
+
+        :param name: what is counted
+        :param callback: returns the current size
+        """
+        self._counters[name] = callback
+
+    def touch(self, guild_id: int):
+        self._last_seen[guild_id] = monotonic()
+
+    def forget(self, guild_id: int):
+        """
+        Free the state of a guild.
+
+        :param guild_id: guild id
+        """
+        self._last_seen.pop(guild_id, None)
+        for reclaimer in self._reclaimers:
+            try:
+                reclaimer(guild_id)
+            except Exception as e:
+                print(f"Reclaiming guild {guild_id} failed: {e!r}")
+
+    def shed(self):
+        """
+        Empty every registered cache.
+        """
+        for shedder in self._shedders:
+            shedder()
+        collect_garbage()
+
+    def collect(self, bot) -> int:
+        """
+        Free the state of guilds the bot left or that are idle.
+        A guild with a voice connection is never idle.
+
+        :param bot: bot
+        :return: number of guilds freed
+        """
+        now, freed = monotonic(), 0
+        for guild_id, last_seen in list(self._last_seen.items()):
+            guild = bot.get_guild(guild_id)
+            if guild is None or (guild.voice_client is None and
+                                 now - last_seen > _IDLE_GUILD_TIMEOUT):
+                self.forget(guild_id)
+                freed += 1
+        return freed
+
+    def usage(self) -> list[tuple[str, str]]:
+        """
+        Describe current usage against the limits.
+
+        :return: (name, value)
+        """
+        def megabytes(size: int) -> str:
+            return f"{size / 1024 / 1024:.1f}MB"
+
+        lines = [
+            ("memory", megabytes(memory_usage())),
+            ("memory limit", megabytes(_MEMORY_LIMIT) if _MEMORY_LIMIT
+             else "none"),
+            ("disk cache", megabytes(StorageManager.cache_size())),
+            ("disk cache limit", megabytes(_CACHE_LIMIT) if _CACHE_LIMIT
+             else "none"),
+            ("lean mode", str(_LEAN_MODE))]
+        lines.extend((k, str(v())) for k, v in self._counters.items())
+        return lines
+
+    async def run(self, bot):
+        """
+        Collect guild state and enforce the limits until cancelled.
+
+        :param bot: bot
+        """
+        while True:
+            await sleep(_INTERVAL)
+            try:
+                self.collect(bot)
+                if _MEMORY_LIMIT and memory_usage() > _MEMORY_LIMIT:
+                    self.shed()
+                    if memory_usage() > _MEMORY_LIMIT:
+                        print(f"Memory usage {memory_usage()} is above the "
+                              f"limit after shedding caches.")
+                if _CACHE_LIMIT:
+                    await to_thread(StorageManager.trim_cache, _CACHE_LIMIT)
+            except Exception as e:
+                print(f"Resource governor failed: {e!r}")
+
+
+async def activity_middleware(spec, ctx, call_next):
+    """
+    Dispatch middleware that marks the guild of a command as active.
+    """
+    if ctx.guild is not None:
+        ResourceGovernor().touch(ctx.guild.id)
+    return await call_next()
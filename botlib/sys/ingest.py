@@ -0,0 +1,529 @@
+# -*- coding: utf-8 -*-
+# botlib/sys/ingest.py
+
+"""
+Catalog ingest for the music player.
+
+    python -m botlib.sys.ingest job.json [job.json ...]
+    python -m botlib.sys.ingest --watch [--interval 30]
+
+A job is a JSON file beside its source audio and optional cover image:
+
+    {"author": "0A", "source": "song.flac", "image": "cover.png",
+     "metadata": {"en": {"title": "...", "authors": ["..."], "alias": ""},
+                  "ko": {"title": "...", "authors": ["..."], "alias": ""}}}
+
+A job with an "id" replaces that track instead of adding one. Locales
+without metadata use the "none" entry, or the first one given.
+The watcher ingests every <INGEST_ENTRY>/<name>/job.json with the files
+beside it, so job.json should be uploaded last. Only one watcher may run
+per catalog.
+"""
+
+from argparse import ArgumentParser
+from asyncio import run as run_async
+from asyncio import sleep, to_thread
+from botlib.sys.bus import InvalidationBus, LocalBus
+from botlib.sys.config import Config
+from botlib.sys.manager import Locale, StorageManager
+from collections.abc import Callable
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from json import dumps as dumps_json
+from json import load as load_json
+from json import loads as loads_json
+from multiprocessing import get_context
+from os import makedirs
+from os.path import dirname
+from os.path import join as path_combine
+from string import ascii_letters, digits
+from subprocess import DEVNULL, run
+from sys import exit
+from tempfile import TemporaryDirectory
+
+__all__ = ["CatalogIngest", "IngestJob", "main"]
+
+_PLAYER_RESOURCE_ENTRY = Config.get("PLAYER_RESOURCE_ENTRY")
+_INGEST_ENTRY = Config.get("INGEST_ENTRY", "dynamic/ingest/")
+_BITRATE = int(Config.get("INGEST_BITRATE", "128"))
+_WORKERS = int(Config.get("INGEST_WORKERS", "2"))
+_THUMBNAIL_SIZE = 512
+_UPDATE_ATTEMPTS = 5
+# track ids are two characters of author and two of music
+_ID_CHARS = digits + ascii_letters
+
+
+def _ffmpeg(*args: str):
+    result = run(["ffmpeg", "-y", "-nostdin", "-loglevel", "error", *args],
+                 stdin=DEVNULL, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"FFmpeg failed: {result.stderr.strip()}")
+
+
+def _prepare(source: str, image: str | None, directory: str,
+             bitrate: int) -> tuple[str, str]:
+    """
+    Transcode a track and render its thumbnail, in a pool process.
+    Without an image, the cover art of the source or its waveform is used.
+
+    :param source: source audio path
+    :param image: cover image path
+    :param directory: directory for the outputs
+    :param bitrate: Opus bitrate in kbps
+    :return: resource path, thumbnail path
+    """
+    resource = path_combine(directory, "resource.webm")
+    thumbnail = path_combine(directory, "thumbnail.webp")
+    _ffmpeg("-i", source, "-map", "0:a:0", "-map_metadata", "-1",
+            "-c:a", "libopus", "-b:a", f"{bitrate}k", "-ar", "48000",
+            "-ac", "2", "-f", "webm", resource)
+    size = _THUMBNAIL_SIZE
+    fit = (f"scale={size}:{size}:force_original_aspect_ratio=increase,"
+           f"crop={size}:{size}")
+    output = ("-frames:v", "1", "-c:v", "libwebp", "-quality", "80",
+              thumbnail)
+    if image is not None:
+        _ffmpeg("-i", image, "-vf", fit, *output)
+        return resource, thumbnail
+    try:
+        _ffmpeg("-i", source, "-map", "0:v:0", "-vf", fit, *output)
+    except RuntimeError:
+        # the source has no cover art
+        _ffmpeg("-i", source, "-filter_complex",
+                f"[0:a]showwavespic=s={size}x{size}[v]", "-map", "[v]",
+                *output)
+    return resource, thumbnail
+
+
+def _schema_key(author: str, locale: Locale) -> str:
+    return path_combine(_PLAYER_RESOURCE_ENTRY, author,
+                        f"schema_{str(locale.value)}.json")
+
+
+def _file_key(id_: str, name: str) -> str:
+    return path_combine(_PLAYER_RESOURCE_ENTRY, id_[:2], id_[2:], name)
+
+
+def _update_json(key: str,
+                 change: Callable[[dict | None], dict | None]):
+    """
+    Read, change and write back a JSON object, retrying when another
+    writer changed it in between. Readers see the old or the new object.
+
+    :param key: object key
+    :param change: returns the new object from the current one, which is
+                   None if it does not exist. None keeps it as it is.
+    :raise RuntimeError: If the object kept changing
+    """
+    for _ in range(_UPDATE_ATTEMPTS):
+        body, etag = StorageManager().get_versioned(key)
+        data = change(None if body is None else loads_json(body))
+        if data is None:
+            return
+        if StorageManager().put_if_match(
+                key, dumps_json(data, ensure_ascii=False), etag):
+            return
+    raise RuntimeError(f"{key} kept changing while it was updated.")
+
+
+class IngestJob:
+    """
+    A track to add to the catalog, or to replace in it.
+    """
+
+    def __init__(self, data: dict, base_path: str = "", name: str = ""):
+        """
+        :param data: job, as described in the module
+        :param base_path: directory the source and image paths are in
+        :param name: name shown in reports
+        :raise ValueError: If the job is malformed
+        """
+        self.name = name
+        self.author = str(data.get("author", ""))
+        self.id: str | None = data.get("id")
+        self.added = self.id is None
+        self.error: Exception | None = None
+        if len(self.author) != 2 or \
+                any(i not in _ID_CHARS for i in self.author):
+            raise ValueError(f"Invalid author id {self.author!r}.")
+        if self.id is not None and (
+                len(self.id) != 4 or not self.id.startswith(self.author) or
+                any(i not in _ID_CHARS for i in self.id)):
+            raise ValueError(f"Invalid music id {self.id!r}.")
+        if not data.get("source"):
+            raise ValueError("Source audio is required.")
+        self.source = path_combine(base_path, data["source"])
+        self.image = path_combine(base_path, data["image"]) \
+            if data.get("image") else None
+        metadata = data.get("metadata") or {}
+        if not metadata:
+            raise ValueError("Metadata is required.")
+        fallback = metadata.get(Locale.NONE.value,
+                                next(iter(metadata.values())))
+        self.metadata: dict[Locale, dict] = {}
+        for locale in Locale:
+            entry = metadata.get(locale.value, fallback)
+            authors = entry.get("authors")
+            if isinstance(authors, str):
+                authors = [authors]
+            if not entry.get("title") or not authors:
+                raise ValueError(f"Title and authors are required for "
+                                 f"{locale.value}.")
+            self.metadata[locale] = {"title": str(entry["title"]),
+                                     "authors": [str(i) for i in authors],
+                                     "alias": str(entry.get("alias", ""))}
+
+    @staticmethod
+    def load(path: str, name: str | None = None) -> "IngestJob":
+        """
+        Read a job file.
+
+        :param path: job file path
+        :param name: name shown in reports, the path by default
+        :return: job
+        :raise ValueError: If the job is malformed
+        """
+        with open(path, encoding="utf-8") as file:
+            return IngestJob(load_json(file), dirname(path), name or path)
+
+    def schema(self, locale: Locale, bitrate: int) -> dict:
+        """
+        Get the schema entry of the track.
+        The codec is recorded so players never probe the resource.
+
+        :param locale: locale
+        :param bitrate: Opus bitrate in kbps
+        :return: schema entry
+        """
+        return {**self.metadata[locale], "id": self.id, "codec": "opus",
+                "bitrate": bitrate}
+
+
+class CatalogIngest:
+    """
+    A class that adds tracks to the player catalog.
+    Tracks are transcoded in worker processes and uploaded before the
+    schemas list them, and root.json lists a new author only after its
+    schemas exist, so readers never see a track without its files.
+    A failed ingest takes its tracks back out of every schema and deletes
+    the files of new ones, so a retry starts clean and no id is leaked.
+    Replaced tracks keep their new files, as they share the old keys.
+    """
+
+    def __init__(self, workers: int = _WORKERS, bitrate: int = _BITRATE):
+        """
+        :param workers: transcoding processes
+        :param bitrate: Opus bitrate in kbps
+        """
+        self._workers = workers
+        self._bitrate = bitrate
+
+    @staticmethod
+    def _allocate(jobs: list[IngestJob]):
+        by_author: dict[str, list[IngestJob]] = {}
+        for job in jobs:
+            by_author.setdefault(job.author, []).append(job)
+        for author, group in by_author.items():
+            if all(i.id is not None for i in group):
+                continue
+            body, _ = StorageManager().get_versioned(
+                _schema_key(author, Locale.NONE))
+            used = set(loads_json(body)) if body is not None else set()
+            used.update(i.id[2:] for i in group if i.id is not None)
+            free = (i + j for i in _ID_CHARS for j in _ID_CHARS
+                    if i + j not in used)
+            for job in group:
+                if job.id is not None:
+                    continue
+                code = next(free, None)
+                if code is None:
+                    job.error = RuntimeError(f"Author {author} has no free "
+                                             f"music ids.")
+                else:
+                    job.id = author + code
+
+    @staticmethod
+    def _upload(job: IngestJob, resource: str, thumbnail: str):
+        StorageManager().upload(_file_key(job.id, "resource.webm"),
+                                resource, "audio/webm")
+        StorageManager().upload(_file_key(job.id, "thumbnail.webp"),
+                                thumbnail, "image/webp")
+
+    def _merge(self, schema: dict | None, jobs: list[IngestJob],
+               locale: Locale, previous: dict) -> dict:
+        schema = schema or {}
+        # a retried write starts over from the schema it read again
+        previous.clear()
+        for job in jobs:
+            if job.added and job.id[2:] in schema:
+                raise RuntimeError(f"Music {job.id} was added by another "
+                                   f"ingest meanwhile.")
+            previous[job.id[2:]] = schema.get(job.id[2:])
+            schema[job.id[2:]] = job.schema(locale, self._bitrate)
+        return schema
+
+    def _write(self, author: str, jobs: list[IngestJob]) \
+            -> dict[Locale, dict]:
+        """
+        Add the tracks of an author to the schema of every locale, or to
+        none of them.
+
+        :param author: author id
+        :param jobs: uploaded jobs of the author
+        :return: locale -> the entries the tracks replaced, for _restore
+        :raise Exception: If a schema could not be written, after the
+                          written ones were restored
+        """
+        written = {}
+        try:
+            for locale in Locale:
+                previous = {}
+                _update_json(_schema_key(author, locale),
+                             lambda schema: self._merge(schema, jobs, locale,
+                                                        previous))
+                written[locale] = previous
+        except Exception:
+            self._restore(author, written)
+            raise
+        return written
+
+    @staticmethod
+    def _restore(author: str, written: dict[Locale, dict]):
+        """
+        Put back the schema entries an ingest replaced. Other entries are
+        left alone, so writers in between keep their changes.
+
+        :param author: author id
+        :param written: locale -> music code -> its entry before, None if
+                        the ingest added it
+        """
+        def change(schema: dict | None, previous: dict) -> dict | None:
+            if schema is None:
+                return None
+            for code, entry in previous.items():
+                if entry is None:
+                    schema.pop(code, None)
+                else:
+                    schema[code] = entry
+            return schema
+
+        for locale, previous in written.items():
+            key = _schema_key(author, locale)
+            try:
+                _update_json(key, lambda schema: change(schema, previous))
+            except Exception as e:
+                print(f"Could not roll back {key}: {e!r}")
+
+    @staticmethod
+    def _discard(jobs: list[IngestJob]):
+        """
+        Delete the files uploaded for new tracks that failed, unless the
+        catalog lists their id anyway because another ingest took it.
+
+        :param jobs: jobs
+        """
+        failed = [i for i in jobs
+                  if i.error is not None and i.added and i.id is not None]
+        listed: dict[str, set[str]] = {}
+        for job in failed:
+            try:
+                if job.author not in listed:
+                    body, _ = StorageManager().get_versioned(
+                        _schema_key(job.author, Locale.NONE))
+                    listed[job.author] = set(loads_json(body)) \
+                        if body is not None else set()
+                if job.id[2:] in listed[job.author]:
+                    continue
+                for name in ("resource.webm", "thumbnail.webp"):
+                    StorageManager().delete(_file_key(job.id, name))
+            except Exception as e:
+                print(f"Could not delete the files of {job.id}: {e!r}")
+
+    @staticmethod
+    def _register(authors: set[str]):
+        def change(root: dict | None) -> dict | None:
+            root = root or {"authors": []}
+            added = sorted(authors - set(root["authors"]))
+            if not added:
+                return None
+            root["authors"] += added
+            return root
+
+        _update_json(path_combine(_PLAYER_RESOURCE_ENTRY, "root.json"),
+                     change)
+
+    def ingest(self, jobs: list[IngestJob]) -> list[IngestJob]:
+        """
+        Add tracks to the catalog.
+        A failed job does not stop the others, and keeps its error.
+
+        :param jobs: jobs
+        :return: jobs that were ingested
+        """
+        self._allocate(jobs)
+        uploaded = []
+        with (TemporaryDirectory() as temp,
+              ProcessPoolExecutor(self._workers,
+                                  mp_context=get_context("spawn"))
+              as executor):
+            futures = {}
+            for index, job in enumerate(jobs):
+                if job.error is not None:
+                    continue
+                directory = path_combine(temp, str(index))
+                makedirs(directory)
+                futures[executor.submit(_prepare, job.source, job.image,
+                                        directory, self._bitrate)] = job
+            # uploads overlap the transcoding of the remaining jobs
+            for future in as_completed(futures):
+                job = futures[future]
+                try:
+                    self._upload(job, *future.result())
+                    uploaded.append(job)
+                except Exception as e:
+                    job.error = e
+        by_author: dict[str, list[IngestJob]] = {}
+        for job in uploaded:
+            by_author.setdefault(job.author, []).append(job)
+        done, written = [], {}
+        for author, group in by_author.items():
+            try:
+                written[author] = self._write(author, group)
+                done.extend(group)
+            except Exception as e:
+                for job in group:
+                    job.error = e
+        try:
+            self._register({i.author for i in done})
+        except Exception as e:
+            # new authors are unreachable without root.json, so the whole
+            # batch is taken back rather than only their tracks
+            for author, previous in written.items():
+                self._restore(author, previous)
+            for job in done:
+                job.error = e
+            done = []
+        self._discard(jobs)
+        return done
+
+    @staticmethod
+    async def publish(jobs: list[IngestJob]):
+        """
+        Tell every bot process which tracks changed, so they update the
+        search index and drop cached schemas without a restart.
+
+        :param jobs: ingested jobs
+        """
+        if not jobs:
+            return
+        await InvalidationBus.get().publish(
+            "catalog", authors=sorted({i.author for i in jobs}),
+            tracks=sorted(i.id for i in jobs))
+
+    @staticmethod
+    def _fetch_inbox(temp: str) -> tuple[list[IngestJob], dict[str, str]]:
+        """
+        Download the pending jobs of the inbox.
+
+        :param temp: directory to download into
+        :return: jobs, and the inbox folder of each job by name
+        """
+        keys = StorageManager().list_keys(_INGEST_ENTRY)
+        folders = {key.rpartition("/")[0] for key in keys
+                   if key.endswith("/job.json")}
+        # a failed job stays until someone fixes or removes it
+        folders -= {key.rpartition("/")[0] for key in keys
+                    if key.endswith("/failed.txt")}
+        jobs, names = [], {}
+        for folder in sorted(folders):
+            name = folder[len(_INGEST_ENTRY):].strip("/")
+            for key in keys:
+                if key.startswith(f"{folder}/"):
+                    StorageManager().download(key, path_combine(
+                        temp, name, key[len(folder) + 1:]))
+            try:
+                jobs.append(IngestJob.load(path_combine(temp, name,
+                                                        "job.json"), name))
+            except Exception as e:
+                StorageManager().put(f"{folder}/failed.txt", repr(e))
+                print(f"Ingest job {name} failed: {e!r}")
+                continue
+            names[name] = folder
+        return jobs, names
+
+    def ingest_inbox(self) -> list[IngestJob]:
+        """
+        Ingest every pending job of the inbox. Finished jobs are removed
+        from it, and failed ones get a failed.txt with the error.
+
+        :return: jobs that were ingested
+        """
+        with TemporaryDirectory() as temp:
+            jobs, folders = self._fetch_inbox(temp)
+            if not jobs:
+                return []
+            done = self.ingest(jobs)
+        keys = StorageManager().list_keys(_INGEST_ENTRY)
+        for job in jobs:
+            folder = folders[job.name]
+            if job.error is not None:
+                StorageManager().put(f"{folder}/failed.txt", repr(job.error))
+                print(f"Ingest job {job.name} failed: {job.error!r}")
+                continue
+            for key in keys:
+                if key.startswith(f"{folder}/"):
+                    StorageManager().delete(key)
+            print(f"Ingested {job.name} as {job.id}.")
+        return done
+
+    async def run(self, interval: float):
+        """
+        Ingest the inbox periodically until cancelled.
+
+        :param interval: seconds between inbox checks
+        """
+        while True:
+            await sleep(interval)
+            try:
+                await self.publish(await to_thread(self.ingest_inbox))
+            except Exception as e:
+                print(f"Catalog ingest failed: {e!r}")
+
+
+def main():
+    parser = ArgumentParser(description="Add tracks to the player catalog")
+    parser.add_argument("jobs", nargs="*", help="job files to ingest")
+    parser.add_argument("--watch", action="store_true",
+                        help="ingest the S3 inbox until interrupted")
+    parser.add_argument("--interval", type=float, default=30.0,
+                        help="seconds between inbox checks")
+    parser.add_argument("--workers", type=int, default=_WORKERS,
+                        help="transcoding processes")
+    parser.add_argument("--bitrate", type=int, default=_BITRATE,
+                        help="Opus bitrate in kbps")
+    args = parser.parse_args()
+    if not args.jobs and not args.watch:
+        parser.error("give job files or --watch")
+    if isinstance(InvalidationBus.get(), LocalBus):
+        print("BUS_BACKEND is local, so running bots pick up new tracks "
+              "after !dev.invalidate or a restart.")
+    ingest = CatalogIngest(args.workers, args.bitrate)
+    if args.watch:
+        run_async(ingest.run(args.interval))
+        return
+    try:
+        jobs = [IngestJob.load(path) for path in args.jobs]
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    done = ingest.ingest(jobs)
+    for job in jobs:
+        if job.error is not None:
+            print(f"{job.name}: failed, {job.error!r}")
+        else:
+            print(f"{job.name}: ingested as {job.id}")
+    run_async(CatalogIngest.publish(done))
+    if len(done) < len(jobs):
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
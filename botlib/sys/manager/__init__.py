@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
 # botlib/sys/manager/__init__.py
 
-from botlib.sys.manager.localization import Locale, LocaleProperties
+from botlib.sys.manager.localization import (Locale, LocaleProperties,
+                                             forget_locale, guild_locale,
+                                             locale_count, remember_locale)
 from botlib.sys.manager.storage import StorageManager
+from botlib.sys.manager.guildconf import GuildConfigStore
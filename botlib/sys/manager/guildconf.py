@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+# botlib/sys/manager/guildconf.py
+
+from abc import ABC, abstractmethod
+from asyncio import sleep, to_thread
+from botlib.sys.bus import InvalidationBus
+from botlib.sys.config import Config
+from botlib.sys.manager.localization import Locale, remember_locale
+from botlib.sys.manager.storage import StorageManager
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from json import dumps as dumps_json
+from json import loads as loads_json
+from os import environ, makedirs, remove
+from os.path import dirname
+from os.path import exists as file_exists
+from os.path import join as path_combine
+from threading import Lock
+from time import monotonic
+
+__all__ = ["GuildConfigBackend", "GuildConfigStore", "ObjectBackend",
+           "SQLiteBackend"]
+
+_BASE_PATH = Config.get("BASE_PATH")
+_SERVER_CONF_ENTRY = Config.get("SERVER_CONF_ENTRY")
+_BACKEND = Config.get("GUILD_CONF_BACKEND", "object")
+_DB_PATH = path_combine(_BASE_PATH, Config.get("GUILD_CONF_DB_PATH",
+                                               "temp/guild-conf.sqlite"))
+_SNAPSHOT_KEY = path_combine(_SERVER_CONF_ENTRY, "snapshot.sqlite")
+_FLUSH_INTERVAL = float(Config.get("GUILD_CONF_FLUSH_INTERVAL", "5"))
+_SNAPSHOT_INTERVAL = float(Config.get("GUILD_CONF_SNAPSHOT_INTERVAL", "600"))
+_LOAD_WORKERS = 16
+
+
+class GuildConfigBackend(ABC):
+    """
+    Where guild configures are persisted.
+    """
+
+    @abstractmethod
+    def load_many(self, guild_ids: list[int]) -> dict[int, dict]:
+        """
+        Load the configures of several guilds.
+
+        :param guild_ids: guild ids
+        :return: guild id -> configure, registered guilds only
+        """
+
+    @abstractmethod
+    def save_many(self, configs: dict[int, dict]):
+        """
+        Save the configures of several guilds.
+
+        :param configs: guild id -> configure
+        """
+
+    def snapshot(self):
+        """
+        Copy the store to S3, for backends that keep it elsewhere.
+        """
+
+
+class ObjectBackend(GuildConfigBackend):
+    """
+    The legacy layout, one S3 object per guild.
+    """
+
+    @staticmethod
+    def _key(guild_id: int) -> str:
+        return path_combine(_SERVER_CONF_ENTRY, f"{guild_id}.json")
+
+    def _load(self, guild_id: int) -> dict | None:
+        try:
+            return loads_json(StorageManager().get(self._key(guild_id)))
+        except Exception as e:
+            if hasattr(e, "response"):
+                if e.response["ResponseMetadata"]["HTTPStatusCode"] == 404:
+                    return None
+            raise e
+
+    def load_many(self, guild_ids: list[int]) -> dict[int, dict]:
+        # S3 reads are independent, so overlap the round-trips
+        with ThreadPoolExecutor(_LOAD_WORKERS) as executor:
+            configs = executor.map(self._load, guild_ids)
+            return {k: v for k, v in zip(guild_ids, configs) if v is not None}
+
+    def save_many(self, configs: dict[int, dict]):
+        with ThreadPoolExecutor(_LOAD_WORKERS) as executor:
+            list(executor.map(
+                lambda item: StorageManager().put(self._key(item[0]),
+                                                  dumps_json(item[1])),
+                configs.items()))
+
+    def list_guilds(self) -> list[int]:
+        guild_ids = []
+        for key in StorageManager().list_keys(_SERVER_CONF_ENTRY):
+            name = key.rsplit("/", 1)[-1]
+            if name.endswith(".json") and name[:-5].isdigit():
+                guild_ids.append(int(name[:-5]))
+        return guild_ids
+
+
+class SQLiteBackend(GuildConfigBackend):
+    """
+    Every configure in one local SQLite file, copied to S3 periodically.
+    Guilds missing from the file are imported from the legacy layout.
+    It serves one host only: shard workers of the host share the file,
+    but the bot processes of another host would keep reading their own
+    stale copy, even when told on the bus that a configure changed.
+    """
+
+    def __init__(self, path: str = _DB_PATH):
+        from sqlite3 import connect as connect_db
+        self._path = path
+        self._legacy = ObjectBackend()
+        if not file_exists(path):
+            makedirs(dirname(path), exist_ok=True)
+            if StorageManager().exists(_SNAPSHOT_KEY):
+                with open(path, "wb") as file:
+                    file.write(StorageManager().get(_SNAPSHOT_KEY))
+        self._db_connect = connect_db(path, check_same_thread=False)
+        self._db_connect.execute("PRAGMA journal_mode=WAL")
+        self._db_connect.execute(
+            "CREATE TABLE IF NOT EXISTS GuildConfig "
+            "(id INTEGER PRIMARY KEY, data TEXT NOT NULL)")
+        self._db_connect.commit()
+        self._lock = Lock()
+
+    def load_many(self, guild_ids: list[int]) -> dict[int, dict]:
+        configs = {}
+        with self._lock:
+            cursor = self._db_connect.cursor()
+            # stay below the SQLite variable limit
+            for i in range(0, len(guild_ids), 500):
+                chunk = guild_ids[i:i + 500]
+                cursor.execute(
+                    "SELECT id, data FROM GuildConfig WHERE id IN "
+                    f"({','.join('?' * len(chunk))})", chunk)
+                configs.update((k, loads_json(v)) for k, v in cursor)
+        missing = [i for i in guild_ids if i not in configs]
+        if missing:
+            imported = self._legacy.load_many(missing)
+            self.save_many(imported)
+            configs.update(imported)
+        return configs
+
+    def save_many(self, configs: dict[int, dict]):
+        if not configs:
+            return
+        with self._lock:
+            self._db_connect.executemany(
+                "INSERT OR REPLACE INTO GuildConfig (id, data) VALUES (?, ?)",
+                [(k, dumps_json(v)) for k, v in configs.items()])
+            self._db_connect.commit()
+
+    def snapshot(self):
+        from sqlite3 import connect as connect_db
+        # the backup api gives a consistent copy while writes go on
+        temp = f"{self._path}.snapshot"
+        target = connect_db(temp)
+        with self._lock:
+            self._db_connect.backup(target)
+        target.close()
+        StorageManager().put_from_file(_SNAPSHOT_KEY, temp)
+        remove(temp)
+
+
+class GuildConfigStore:
+    """
+    A class that keeps guild configures in memory.
+    Configures are bulk-loaded at startup and written through on change.
+    Writes that failed stay pending and are retried in the background.
+    """
+    _instance = None
+    _initialized: bool = False
+    _init_lock = Lock()
+
+    def __new__(cls, *args, **kwargs):
+        # single-ton pattern
+        if not cls._instance:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self, backend: GuildConfigBackend | None = None):
+        # single-ton, may be warmed up from a worker thread
+        if self._initialized:
+            return
+        with self._init_lock:
+            if self._initialized:
+                return
+            if backend is None:
+                backend = SQLiteBackend() if _BACKEND == "sqlite" \
+                    else ObjectBackend()
+            self._backend = backend
+            self._configs: dict[int, dict | None] = {}
+            self._dirty: set[int] = set()
+            self._lock = Lock()
+            # one flush at a time, so an older copy is never saved last
+            self._flush_lock = Lock()
+            self._initialized = True
+
+    def _remember(self, configs: dict[int, dict | None]):
+        with self._lock:
+            for guild_id, config in configs.items():
+                if guild_id in self._dirty:
+                    # a pending write is newer than what was loaded
+                    continue
+                self._configs[guild_id] = config
+                if config is not None:
+                    remember_locale(guild_id, Locale(config["Locale"]))
+
+    def load_many(self, guild_ids: list[int]) -> int:
+        """
+        Load the configures of guilds that are not in memory yet.
+
+        :param guild_ids: guild ids
+        :return: number of registered guilds loaded
+        """
+        missing = [i for i in guild_ids if i not in self._configs]
+        configs = self._backend.load_many(missing)
+        self._remember({i: configs.get(i) for i in missing})
+        return len(configs)
+
+    def get(self, guild_id: int) -> dict | None:
+        """
+        Get a copy of a guild configure.
+
+        :param guild_id: guild id
+        :return: configure, None if the guild is not registered
+        """
+        if guild_id not in self._configs:
+            self.load_many([guild_id])
+        return deepcopy(self._configs.get(guild_id))
+
+    async def fetch(self, guild_id: int) -> dict | None:
+        """
+        Same as get, but loads from the backend in a worker thread.
+        """
+        if guild_id in self._configs:
+            return deepcopy(self._configs[guild_id])
+        return await to_thread(self.get, guild_id)
+
+    def put(self, guild_id: int, config: dict):
+        """
+        Replace a guild configure. It is written back on the next flush,
+        use write for changes that must not wait for it.
+
+        :param guild_id: guild id
+        :param config: configure
+        """
+        with self._lock:
+            self._configs[guild_id] = deepcopy(config)
+            self._dirty.add(guild_id)
+        remember_locale(guild_id, Locale(config["Locale"]))
+
+    async def write(self, guild_id: int, config: dict):
+        """
+        Replace a guild configure and write it to the backend right away,
+        so the change survives a crash. Other processes are told about it.
+        If the write fails, it stays pending for the background flush.
+
+        :param guild_id: guild id
+        :param config: configure
+        """
+        self.put(guild_id, config)
+        try:
+            written = await to_thread(self.flush)
+        except Exception as e:
+            print(f"Guild configure write failed: {e!r}")
+            return
+        await InvalidationBus.get().publish("guildconf", guilds=written)
+
+    def evict(self, guild_id: int | None = None):
+        """
+        Forget cached configures so the next read goes to the backend.
+        Pending writes are kept.
+
+        :param guild_id: guild id, every guild if None
+        """
+        with self._lock:
+            targets = list(self._configs) if guild_id is None else [guild_id]
+            for target in targets:
+                if target not in self._dirty:
+                    self._configs.pop(target, None)
+
+    def flush(self) -> list[int]:
+        """
+        Write every changed configure to the backend.
+
+        :return: ids of the guilds written
+        """
+        with self._flush_lock:
+            with self._lock:
+                dirty = {i: deepcopy(self._configs[i]) for i in self._dirty}
+            if not dirty:
+                return []
+            # pending writes stay dirty, and are never evicted, until saved
+            self._backend.save_many(dirty)
+            with self._lock:
+                for guild_id, config in dirty.items():
+                    # a configure put again meanwhile is saved next time
+                    if self._configs.get(guild_id) == config:
+                        self._dirty.discard(guild_id)
+            return list(dirty)
+
+    def migrate(self) -> int:
+        """
+        Import every legacy per-guild object into the backend.
+
+        :return: number of guilds imported
+        """
+        legacy = ObjectBackend()
+        configs = legacy.load_many(legacy.list_guilds())
+        if not isinstance(self._backend, ObjectBackend):
+            self._backend.save_many(configs)
+        self._remember(configs)
+        return len(configs)
+
+    async def _on_invalidate(self, message: dict):
+        if message["origin"] == InvalidationBus.get().node:
+            return
+        if message.get("all"):
+            self.evict()
+            return
+        guild_ids = message["guilds"]
+        for guild_id in guild_ids:
+            self.evict(guild_id)
+        # reload eagerly so the remembered locales are current as well
+        await to_thread(self.load_many, guild_ids)
+
+    async def run(self):
+        """
+        Retry pending writes and take snapshots until cancelled.
+        Other processes are told which configures were written.
+        """
+        bus = InvalidationBus.get()
+        bus.subscribe("guildconf", self._on_invalidate)
+        # only one shard worker uploads snapshots
+        snapshot = environ.get("HOLOBOT_WORKER_INDEX", "0") == "0"
+        snapshot_at = monotonic() + _SNAPSHOT_INTERVAL
+        while True:
+            await sleep(_FLUSH_INTERVAL)
+            try:
+                if self._dirty:
+                    written = await to_thread(self.flush)
+                    await bus.publish("guildconf", guilds=written)
+                if snapshot and monotonic() >= snapshot_at:
+                    await to_thread(self._backend.snapshot)
+                    snapshot_at = monotonic() + _SNAPSHOT_INTERVAL
+            except Exception as e:
+                print(f"Guild configure flush failed: {e!r}")
+
+    def guild_count(self) -> int:
+        return len(self._configs)
@@ -3,12 +3,18 @@
 
 from botlib.sys.config import Config
 from enum import Enum, unique
+from os.path import getmtime
 from os.path import join as path_combine
 from XProperties import Properties
 
-__all__ = ["Locale", "LocaleProperties"]
+__all__ = ["Locale", "LocaleProperties", "forget_locale", "guild_locale",
+           "locale_count", "remember_locale"]
 
 _LOCALE_PATH = path_combine(Config.get("BASE_PATH"), Config.get("LOCALE_PATH"))
+# guild id -> locale, filled whenever a server configure is read
+_GUILD_LOCALES: dict[int, "Locale"] = {}
+# path -> (modified time, parsed file), reparsed when the file changes
+_PROPERTIES: dict[str, tuple[float, Properties]] = {}
 
 
 @unique
@@ -23,16 +29,51 @@ class LocaleProperties:
         self._name = name
         self._current_locale = locale
 
-    def get(self, key: str) -> str | None:
+    def _path(self) -> str:
         if self._current_locale == Locale.NONE:
             filename = f"{self._name}.xml"
         else:
             filename = f"{self._name}_{self._current_locale.value}.xml"
-        path = path_combine(_LOCALE_PATH, filename)
-        prop = Properties()
-        prop.load_from_xml(path)
-        return prop.get_property(key, "NaN")
+        return path_combine(_LOCALE_PATH, filename)
+
+    def get(self, key: str) -> str | None:
+        path = self._path()
+        modified = getmtime(path)
+        if path not in _PROPERTIES or _PROPERTIES[path][0] != modified:
+            prop = Properties()
+            prop.load_from_xml(path)
+            _PROPERTIES[path] = (modified, prop)
+        return _PROPERTIES[path][1].get_property(key, "NaN")
+
+    @property
+    def version(self) -> float:
+        """
+        Modified time of the locale file, which changes with its content.
+        """
+        return getmtime(self._path())
 
     @property
     def current_locale(self) -> Locale:
         return self._current_locale
+
+
+def remember_locale(guild_id: int, locale: Locale):
+    _GUILD_LOCALES[guild_id] = locale
+
+
+def guild_locale(guild_id: int) -> Locale:
+    """
+    Get the last known locale of a guild without reading its configure.
+
+    :param guild_id: guild id
+    :return: locale, Locale.NONE if unknown
+    """
+    return _GUILD_LOCALES.get(guild_id, Locale.NONE)
+
+
+def forget_locale(guild_id: int):
+    _GUILD_LOCALES.pop(guild_id, None)
+
+
+def locale_count() -> int:
+    return len(_GUILD_LOCALES)
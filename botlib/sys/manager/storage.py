@@ -1,15 +1,46 @@
 # -*- coding: utf-8 -*-
 # botlib/sys/manager/storage.py
 
-from boto3 import client as s3
 from botlib.sys.config import Config
-from os import makedirs
+from botlib.sys.metrics import Metrics
+from contextlib import contextmanager
+from hashlib import sha1
+from os import chmod, getpid, link, makedirs, remove, replace, walk
+from os import stat as file_stat
 from os.path import dirname
 from os.path import exists as file_exists
 from os.path import join as path_combine
+from shutil import copyfileobj
+from threading import BoundedSemaphore, Lock, get_ident
+from time import monotonic
 
 _CACHE_PATH = path_combine(Config.get("BASE_PATH"), Config.get("CACHE_PATH"))
+# bodies by ETag and per-key lock files, beside the per-key links
+_BLOB_PATH = path_combine(_CACHE_PATH, ".blobs")
+_LOCK_PATH = path_combine(_CACHE_PATH, ".locks")
 _BUCKET_NAME = Config.get("AWS_S3_NAME")
+_CACHE_SIZE_TTL = 60.0
+_MULTIPART_SIZE = int(Config.get("S3_MULTIPART_MB", "8")) * 1024 * 1024
+
+_STORAGE_SECONDS = Metrics().histogram("holobot_storage_seconds",
+                                       "S3 request latency")
+_CACHE_REQUESTS = Metrics().counter("holobot_storage_cache_total",
+                                    "Cache lookups by result")
+_S3_SLOTS = BoundedSemaphore(int(Config.get("S3_CONCURRENCY", "8")))
+
+
+@contextmanager
+def _request(operation: str):
+    """
+    Hold one of the S3 request slots of the process, however the request
+    was started, and time it. Requests run in worker threads, so waiting
+    for a slot never blocks the event loop; commands are admitted before
+    that by the "s3" AdmissionGate, which rejects instead of waiting.
+
+    :param operation: operation label of the latency metric
+    """
+    with _S3_SLOTS, _STORAGE_SECONDS.time(operation=operation):
+        yield
 
 
 class StorageManager:
@@ -18,6 +49,8 @@ class StorageManager:
     """
     _instance = None
     _initialized: bool = False
+    _lock = Lock()
+    _cache_size: tuple[float, int] = (0.0, 0)
 
     def __new__(cls, *args, **kwargs):
         # single-ton pattern
@@ -25,14 +58,31 @@ class StorageManager:
             cls._instance = super().__new__(cls)
         return cls._instance
 
-    def __init__(self):
-        # single-ton
+    def __init__(self, client=None):
+        """
+        :param client: S3 client to use instead of boto3, e.g. a local
+                       stand-in. Only the first construction uses it.
+        """
+        # single-ton, may be warmed up from a worker thread
         if self._initialized:
             return
-        self._initialized = True
-        self._s3 = s3("s3", aws_access_key_id=Config.get("AWS_PUBLIC_KEY"),
-                      aws_secret_access_key=Config.get("AWS_PRIVATE_KEY"),
-                      region_name=Config.get("AWS_REGION"))
+        with self._lock:
+            if self._initialized:
+                return
+            self._transfer = None
+            if client is None:
+                # boto3 is slow to import, so defer it to the first use
+                from boto3 import client as s3
+                from boto3.s3.transfer import TransferConfig
+                client = s3(
+                    "s3", aws_access_key_id=Config.get("AWS_PUBLIC_KEY"),
+                    aws_secret_access_key=Config.get("AWS_PRIVATE_KEY"),
+                    region_name=Config.get("AWS_REGION"))
+                self._transfer = TransferConfig(
+                    multipart_threshold=_MULTIPART_SIZE,
+                    multipart_chunksize=_MULTIPART_SIZE)
+            self._s3 = client
+            self._initialized = True
 
     @staticmethod
     def format_key_to_url(key: str) -> str:
@@ -57,20 +107,68 @@ class StorageManager:
             return True
         return False
 
-    def _caching(self, key: str, data: bytes, force: bool = False):
+    def _caching(self, key: str, body, etag: str | None = None,
+                 writable: bool = False):
         """
         Cache object to EBS storage.
+        Bodies are stored once per ETag and every key is a read-only hard
+        link to one, so processes sharing the volume share each copy.
 
         :param key: object key
-        :param data: object body
-        :param force: If True, cache again even if already cached
+        :param body: object body, bytes or a readable stream
+        :param etag: ETag of the object
+        :param writable: If True, store a private copy the caller may
+                         modify instead of a link
         """
-        if self._is_cached(key) and not force:
-            return
         path = path_combine(_CACHE_PATH, key)
         makedirs(dirname(path), exist_ok=True)
+        # readers check for the file only, so it must appear complete
+        temp = f"{path}.{getpid()}.{get_ident()}.tmp"
+        if writable or not etag:
+            self._write(temp, body)
+            replace(temp, path)
+            return
+        blob = path_combine(_BLOB_PATH, etag.strip('"'))
+        try:
+            # a stored body is shared, and the download is left unread
+            link(blob, temp)
+        except FileNotFoundError:
+            # not stored yet, or trim_cache of another process removed it
+            makedirs(_BLOB_PATH, exist_ok=True)
+            blob_temp = f"{blob}.{getpid()}.{get_ident()}.tmp"
+            self._write(blob_temp, body)
+            chmod(blob_temp, 0o444)
+            # linked before it is published, so a trim cannot take it
+            link(blob_temp, temp)
+            replace(blob_temp, blob)
+        replace(temp, path)
+
+    @staticmethod
+    def _write(path: str, body):
         with open(path, "wb") as file:
-            file.write(data)
+            if isinstance(body, bytes):
+                file.write(body)
+            else:
+                copyfileobj(body, file, 1024 * 1024)
+
+    @staticmethod
+    @contextmanager
+    def _key_lock(key: str):
+        """
+        Hold the lock of an object key, shared by every process on the
+        host, so only one of them downloads the object.
+
+        :param key: object key
+        """
+        from fcntl import LOCK_EX, LOCK_UN, flock
+        makedirs(_LOCK_PATH, exist_ok=True)
+        name = sha1(key.encode("utf-8")).hexdigest()
+        with open(path_combine(_LOCK_PATH, f"{name}.lock"), "ab") as file:
+            flock(file, LOCK_EX)
+            try:
+                yield
+            finally:
+                flock(file, LOCK_UN)
 
     def _get_cache(self, key: str) -> bytes:
         """
@@ -84,6 +182,18 @@ class StorageManager:
         with open(path_combine(_CACHE_PATH, key), "rb") as file:
             return file.read()
 
+    def discard_cache(self, key: str):
+        """
+        Remove an object from EBS storage, so the next read goes to S3.
+        Readers that opened the file keep reading the old body.
+
+        :param key: object key
+        """
+        try:
+            remove(path_combine(_CACHE_PATH, key))
+        except FileNotFoundError:
+            pass
+
     def get(self, key: str, cache: bool = False) -> bytes:
         """
         Get object from S3 Bucket.
@@ -93,25 +203,107 @@ class StorageManager:
         :return: object body
         """
         if self._is_cached(key):
+            _CACHE_REQUESTS.inc(result="hit")
             return self._get_cache(key)
-        resp = self._s3.get_object(Bucket=_BUCKET_NAME, Key=key)
-        data = resp["Body"].read()
+        _CACHE_REQUESTS.inc(result="miss")
+        with _request("get"):
+            resp = self._s3.get_object(Bucket=_BUCKET_NAME, Key=key)
+            data = resp["Body"].read()
         if cache:
-            self._caching(key, data)
+            self._caching(key, data, resp.get("ETag"))
         return data
 
-    def get_to_file(self, key: str) -> str:
+    @staticmethod
+    def _is_shared(key: str) -> bool:
+        """
+        Check if the cached object is a read-only link to a stored body.
+
+        :param key: object key
+        :return: bool
+        """
+        try:
+            mode = file_stat(path_combine(_CACHE_PATH, key)).st_mode
+        except FileNotFoundError:
+            return False
+        return not mode & 0o222
+
+    def get_to_file(self, key: str, writable: bool = False) -> str:
         """
         Get object file path.
+        The file is read-only and shared with other processes, unless
+        writable is set.
 
         :param key: object key
+        :param writable: If True, the file is a private copy
         :return: file path
         """
-        if not self._is_cached(key):
+        path = path_combine(_CACHE_PATH, key)
+        if self._is_cached(key) and not (writable and self._is_shared(key)):
+            _CACHE_REQUESTS.inc(result="hit")
+            return path
+        with self._key_lock(key):
+            # another process may have downloaded it while this one waited
+            if self._is_cached(key) and writable and self._is_shared(key):
+                # writing to the link would change the body of every key
+                _CACHE_REQUESTS.inc(result="hit")
+                self._unshare(key)
+            elif self._is_cached(key):
+                _CACHE_REQUESTS.inc(result="hit")
+            else:
+                _CACHE_REQUESTS.inc(result="miss")
+                with _request("get"):
+                    resp = self._s3.get_object(Bucket=_BUCKET_NAME, Key=key)
+                    self._caching(key, resp["Body"], resp.get("ETag"),
+                                  writable)
+        return path
+
+    def _unshare(self, key: str):
+        """
+        Replace the cached link of an object with a private copy.
+        Call it with the key lock held.
+
+        :param key: object key
+        """
+        path = path_combine(_CACHE_PATH, key)
+        temp = f"{path}.{getpid()}.{get_ident()}.tmp"
+        try:
+            with open(path, "rb") as file:
+                self._write(temp, file)
+        except FileNotFoundError:
+            # removed by trim_cache meanwhile, so download it again
+            with _request("get"):
+                resp = self._s3.get_object(Bucket=_BUCKET_NAME, Key=key)
+                self._write(temp, resp["Body"])
+        replace(temp, path)
+
+    def get_versioned(self, key: str) -> tuple[bytes | None, str | None]:
+        """
+        Get object from S3 Bucket with its ETag, bypassing the cache.
+
+        :param key: object key
+        :return: object body and ETag, both None if it does not exist
+        """
+        try:
+            with _request("get"):
+                resp = self._s3.get_object(Bucket=_BUCKET_NAME, Key=key)
+                return resp["Body"].read(), resp.get("ETag")
+        except Exception as e:
+            if hasattr(e, "response"):
+                if e.response["ResponseMetadata"]["HTTPStatusCode"] == 404:
+                    return None, None
+            raise e
+
+    def download(self, key: str, path: str):
+        """
+        Get object to a file outside the cache.
+
+        :param key: object key
+        :param path: file path
+        """
+        makedirs(dirname(path), exist_ok=True)
+        with _request("get"):
             resp = self._s3.get_object(Bucket=_BUCKET_NAME, Key=key)
-            data = resp["Body"].read()
-            self._caching(key, data)
-        return path_combine(_CACHE_PATH, key)
+            self._write(path, resp["Body"])
 
     def put(self, key: str, data: str | bytes):
         """
@@ -122,7 +314,8 @@ class StorageManager:
         """
         if isinstance(data, str):
             data = data.encode("utf-8")
-        self._s3.put_object(Bucket=_BUCKET_NAME, Key=key, Body=data)
+        with _request("put"):
+            self._s3.put_object(Bucket=_BUCKET_NAME, Key=key, Body=data)
 
     def put_from_file(self, key: str, path: str):
         """
@@ -134,6 +327,78 @@ class StorageManager:
         with open(path, "rb") as file:
             self.put(key, file.read())
 
+    def put_if_match(self, key: str, data: str | bytes,
+                     etag: str | None) -> bool:
+        """
+        Put object to S3 Bucket only if nobody changed it since it was
+        read, so read-modify-write cycles of several writers do not lose
+        each other's changes.
+
+        :param key: object key
+        :param data: object body
+        :param etag: ETag it was read with, None if it did not exist
+        :return: False if the object changed in between
+        """
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        condition = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+        try:
+            with _request("put"):
+                self._s3.put_object(Bucket=_BUCKET_NAME, Key=key, Body=data,
+                                    **condition)
+            return True
+        except Exception as e:
+            if hasattr(e, "response"):
+                # 409 is a conditional write racing another one
+                if e.response["ResponseMetadata"]["HTTPStatusCode"] in \
+                        (409, 412):
+                    return False
+            raise e
+
+    def upload(self, key: str, path: str, content_type: str | None = None):
+        """
+        Put object from file path, in parts uploaded concurrently once it
+        is larger than S3_MULTIPART_MB.
+
+        :param key: object key
+        :param path: file path
+        :param content_type: Content-Type of the object
+        """
+        extra = {"ExtraArgs": {"ContentType": content_type}} \
+            if content_type else {}
+        if self._transfer is not None:
+            extra["Config"] = self._transfer
+        with _request("upload"):
+            self._s3.upload_file(Filename=path, Bucket=_BUCKET_NAME, Key=key,
+                                 **extra)
+
+    def delete(self, key: str):
+        """
+        Delete object from S3 Bucket.
+
+        :param key: object key
+        """
+        with _request("delete"):
+            self._s3.delete_object(Bucket=_BUCKET_NAME, Key=key)
+
+    def list_keys(self, prefix: str) -> list[str]:
+        """
+        List object keys under a prefix.
+
+        :param prefix: key prefix
+        :return: object keys
+        """
+        keys, token = [], ""
+        while True:
+            kwargs = {"ContinuationToken": token} if token else {}
+            with _request("list"):
+                resp = self._s3.list_objects_v2(Bucket=_BUCKET_NAME,
+                                                Prefix=prefix, **kwargs)
+            keys.extend(i["Key"] for i in resp.get("Contents", []))
+            if not resp.get("IsTruncated"):
+                return keys
+            token = resp["NextContinuationToken"]
+
     def exists(self, key: str) -> bool:
         """
         Checks whether an object exists.
@@ -142,10 +407,93 @@ class StorageManager:
         :return: bool
         """
         try:
-            self._s3.get_object(Bucket=_BUCKET_NAME, Key=key)
+            with _request("exists"):
+                self._s3.get_object(Bucket=_BUCKET_NAME, Key=key)
             return True
         except Exception as e:
             if hasattr(e, "response"):
                 if e.response["ResponseMetadata"]["HTTPStatusCode"] == 404:
                     return False
             raise e
+
+    @staticmethod
+    def cache_size() -> int:
+        """
+        Get the bytes used by the disk cache.
+        The directory walk is reused for a minute.
+
+        :return: bytes
+        """
+        updated, size = StorageManager._cache_size
+        if updated and monotonic() - updated < _CACHE_SIZE_TTL:
+            return size
+        size, seen = 0, set()
+        for root, _, files in walk(_CACHE_PATH):
+            for name in files:
+                try:
+                    stat = file_stat(path_combine(root, name))
+                except OSError:
+                    continue
+                # hard links to one body are counted once
+                if (stat.st_dev, stat.st_ino) not in seen:
+                    seen.add((stat.st_dev, stat.st_ino))
+                    size += stat.st_size
+        StorageManager._cache_size = (monotonic(), size)
+        return size
+
+    @staticmethod
+    def trim_cache(limit: int) -> int:
+        """
+        Remove the least recently read objects until the disk cache fits.
+        Only shared read-only objects are removed, never private copies.
+
+        :param limit: bytes
+        :return: bytes freed
+        """
+        links, bodies, size = [], {}, 0
+        for root, dirs, files in walk(_CACHE_PATH):
+            if root == _CACHE_PATH:
+                dirs[:] = [i for i in dirs if i != ".locks"]
+            for name in files:
+                if name.endswith(".tmp"):
+                    # still being written
+                    continue
+                path = path_combine(root, name)
+                try:
+                    stat = file_stat(path)
+                except OSError:
+                    continue
+                inode = (stat.st_dev, stat.st_ino)
+                if root == _BLOB_PATH:
+                    bodies[inode] = (path, stat.st_size, stat.st_nlink)
+                    size += stat.st_size
+                elif not stat.st_mode & 0o222:
+                    links.append((stat.st_atime, path, inode))
+                else:
+                    size += stat.st_size
+        freed = 0
+        # bodies without any key are removed first, then by last access
+        order = [(None, None, k) for k, v in bodies.items() if v[2] == 1]
+        for _, path, inode in order + sorted(links):
+            if size - freed <= limit:
+                break
+            try:
+                if path is not None:
+                    remove(path)
+                if inode not in bodies:
+                    continue
+                body, body_size, links_left = bodies[inode]
+                links_left -= path is not None
+                bodies[inode] = (body, body_size, links_left)
+                if links_left <= 1:
+                    remove(body)
+                    del bodies[inode]
+                    freed += body_size
+            except FileNotFoundError:
+                pass
+        StorageManager._cache_size = (0.0, 0)
+        return freed
+
+
+Metrics().gauge("holobot_storage_cache_bytes", "Disk cache size",
+                StorageManager.cache_size)
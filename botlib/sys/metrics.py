@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-
+# botlib/sys/metrics.py
+
+from asyncio import start_server, to_thread
+from botlib.sys.config import Config
+from collections import Counter as TallyCounter
+from collections.abc import Callable
+from contextlib import contextmanager
+from os import environ
+from sys import _current_frames
+from threading import Event, Lock, Thread, main_thread
+from time import perf_counter
+
+__all__ = ["Counter", "Gauge", "Histogram", "Metrics", "SamplingProfiler",
+           "metrics_middleware", "start_metrics_server"]
+
+_METRICS_PORT = int(Config.get("METRICS_PORT", "0"))
+_DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                    10.0)
+
+
+def _format_labels(labels: tuple[tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(f'{k}="{v}"' for k, v in labels)
+    return "{" + pairs + "}"
+
+
+class Counter:
+    """
+    A monotonically increasing value per label set.
+    """
+    kind = "counter"
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self._values: dict[tuple, float] = {}
+        self._lock = Lock()
+
+    def inc(self, amount: float = 1.0, **labels: str):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(tuple(sorted(labels.items())), 0.0)
+
+    def label_sets(self) -> list[dict[str, str]]:
+        with self._lock:
+            return [dict(k) for k in self._values]
+
+    def samples(self) -> list[tuple[str, tuple, float]]:
+        # scrapes run in a worker thread while the loop keeps counting
+        with self._lock:
+            return [(self.name, k, v) for k, v in self._values.items()]
+
+
+class Gauge:
+    """
+    A value that can go up and down, or is read from a callback on scrape.
+    """
+    kind = "gauge"
+
+    def __init__(self, name: str, description: str,
+                 callback: Callable[[], float] | None = None):
+        self.name = name
+        self.description = description
+        self._callback = callback
+        self._values: dict[tuple, float] = {}
+        self._lock = Lock()
+
+    def set(self, value: float, **labels: str):
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] = value
+
+    def value(self, **labels: str) -> float:
+        if self._callback is not None:
+            return float(self._callback())
+        return self._values.get(tuple(sorted(labels.items())), 0.0)
+
+    def samples(self) -> list[tuple[str, tuple, float]]:
+        if self._callback is not None:
+            try:
+                return [(self.name, (), float(self._callback()))]
+            except Exception as e:
+                print(f"Gauge {self.name} failed: {e!r}")
+                return []
+        with self._lock:
+            return [(self.name, k, v) for k, v in self._values.items()]
+
+
+class Histogram:
+    """
+    A distribution of observed values in cumulative buckets.
+    """
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str,
+                 buckets: tuple[float, ...] = _DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self._buckets = buckets
+        # label set -> [bucket counts..., +Inf count, sum]
+        self._values: dict[tuple, list[float]] = {}
+        self._lock = Lock()
+
+    def observe(self, value: float, **labels: str):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = [0.0] * (len(self._buckets) + 2)
+            data = self._values[key]
+            for i, bound in enumerate(self._buckets):
+                if value <= bound:
+                    data[i] += 1
+            data[-2] += 1
+            data[-1] += value
+
+    @contextmanager
+    def time(self, **labels: str):
+        """
+        Observe how long the with block takes.
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    def count(self, **labels: str) -> int:
+        data = self._values.get(tuple(sorted(labels.items())))
+        return int(data[-2]) if data else 0
+
+    def quantile(self, q: float, **labels: str) -> float:
+        """
+        Estimate a quantile from the bucket bounds.
+
+        :param q: quantile in 0..1
+        :return: upper bound of the bucket holding the quantile
+        """
+        data = self._values.get(tuple(sorted(labels.items())))
+        if not data or not data[-2]:
+            return 0.0
+        rank = q * data[-2]
+        for i, bound in enumerate(self._buckets):
+            if data[i] >= rank:
+                return bound
+        return float("inf")
+
+    def label_sets(self) -> list[dict[str, str]]:
+        with self._lock:
+            return [dict(k) for k in self._values]
+
+    def samples(self) -> list[tuple[str, tuple, float]]:
+        # copy the counts, as observations go on while a scrape renders
+        with self._lock:
+            values = [(k, list(v)) for k, v in self._values.items()]
+        result = []
+        for key, data in values:
+            for i, bound in enumerate(self._buckets):
+                result.append((f"{self.name}_bucket",
+                               key + (("le", str(bound)),), data[i]))
+            result.append((f"{self.name}_bucket", key + (("le", "+Inf"),),
+                           data[-2]))
+            result.append((f"{self.name}_count", key, data[-2]))
+            result.append((f"{self.name}_sum", key, data[-1]))
+        return result
+
+
+class Metrics:
+    """
+    A class that owns every metric of the process.
+    """
+    _instance = None
+    _initialized: bool = False
+
+    def __new__(cls, *args, **kwargs):
+        # single-ton pattern
+        if not cls._instance:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        # single-ton
+        if self._initialized:
+            return
+        self._initialized = True
+        self._metrics: dict[str, Counter | Gauge | Histogram] = {}
+        self._lock = Lock()
+
+    def _get_or_create(self, cls, name: str, *args):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = cls(name, *args)
+            return self._metrics[name]
+
+    def counter(self, name: str, description: str = "") -> Counter:
+        return self._get_or_create(Counter, name, description)
+
+    def gauge(self, name: str, description: str = "",
+              callback: Callable[[], float] | None = None) -> Gauge:
+        return self._get_or_create(Gauge, name, description, callback)
+
+    def histogram(self, name: str, description: str = "",
+                  buckets: tuple[float, ...] = _DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, description, buckets)
+
+    def get(self, name: str) -> Counter | Gauge | Histogram | None:
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        """
+        Render every metric in the Prometheus text exposition format.
+
+        :return: exposition text
+        """
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class SamplingProfiler:
+    """
+    A profiler that samples the stack of the main thread periodically.
+    It can be started and stopped while the bot is running.
+    """
+    _instance = None
+    _initialized: bool = False
+
+    def __new__(cls, *args, **kwargs):
+        # single-ton pattern
+        if not cls._instance:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        # single-ton
+        if self._initialized:
+            return
+        self._initialized = True
+        self._samples: TallyCounter = TallyCounter()
+        self._stop = Event()
+        self._thread: Thread | None = None
+        self._total = 0
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval: float = 0.005):
+        """
+        Start sampling. Previous samples are discarded.
+
+        :param interval: seconds between samples
+        """
+        if self.running:
+            return
+        self._samples.clear()
+        self._total = 0
+        self._stop.clear()
+        self._thread = Thread(target=self._run, args=(interval,),
+                              name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self, interval: float):
+        target = main_thread().ident
+        while not self._stop.wait(interval):
+            frame = _current_frames().get(target)
+            stack = []
+            while frame is not None and len(stack) < 64:
+                code = frame.f_code
+                stack.append(f"{code.co_filename}:{frame.f_lineno}"
+                             f"({code.co_name})")
+                frame = frame.f_back
+            if stack:
+                self._samples[tuple(reversed(stack))] += 1
+                self._total += 1
+
+    def report(self, top: int = 10) -> list[tuple[str, float]]:
+        """
+        Get the frames that were on top of the stack most often.
+
+        :param top: number of frames
+        :return: (frame, share of samples)
+        """
+        leaves = TallyCounter()
+        for stack, count in self._samples.items():
+            leaves[stack[-1]] += count
+        total = self._total or 1
+        return [(frame, count / total)
+                for frame, count in leaves.most_common(top)]
+
+
+async def metrics_middleware(spec, ctx, call_next):
+    """
+    Dispatch middleware that records the latency and errors per command.
+    """
+    metrics = Metrics()
+    metrics.counter("holobot_commands_total",
+                    "Commands dispatched").inc(command=spec.name)
+    try:
+        with metrics.histogram("holobot_command_seconds",
+                               "Command latency").time(command=spec.name):
+            return await call_next()
+    except Exception:
+        metrics.counter("holobot_command_errors_total",
+                        "Commands that raised").inc(command=spec.name)
+        raise
+
+
+async def _serve(reader, writer):
+    try:
+        request = await reader.readline()
+        # the headers are not needed, but must be drained
+        while (await reader.readline()).strip():
+            pass
+        if request.split(b" ")[1:2] == [b"/metrics"]:
+            # gauges may read files, e.g. the size of the disk cache
+            body = (await to_thread(Metrics().render)).encode("utf-8")
+            status = b"200 OK"
+        else:
+            body, status = b"not found\n", b"404 Not Found"
+        writer.write(b"HTTP/1.1 " + status + b"\r\n"
+                     b"Content-Type: text/plain; version=0.0.4\r\n"
+                     b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+                     b"Connection: close\r\n\r\n" + body)
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(port: int | None = None):
+    """
+    Serve /metrics on localhost. Does nothing if the port is 0.
+    Shard workers listen on METRICS_PORT + 1 + their index.
+
+    :param port: tcp port, METRICS_PORT if None
+    """
+    if port is None and _METRICS_PORT:
+        worker = int(environ.get("HOLOBOT_WORKER_INDEX", "-1"))
+        port = _METRICS_PORT + worker + 1
+    if not port:
+        return None
+    return await start_server(_serve, "127.0.0.1", port)
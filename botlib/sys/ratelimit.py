@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+# botlib/sys/ratelimit.py
+
+from asyncio import Semaphore
+from botlib.sys.config import Config
+from botlib.sys.manager import LocaleProperties, guild_locale
+from botlib.sys.metrics import Metrics
+from contextlib import asynccontextmanager
+from math import ceil
+from time import monotonic
+
+__all__ = ["AdmissionGate", "AdmissionRejected", "RateLimiter", "TokenBucket",
+           "rate_limit_middleware"]
+
+_ADMISSION_QUEUE_SIZE = int(Config.get("ADMISSION_QUEUE_SIZE", "32"))
+_ADMISSION_GUILD_LIMIT = int(Config.get("ADMISSION_GUILD_LIMIT", "2"))
+_GATE_LIMITS = {
+    "s3": int(Config.get("S3_CONCURRENCY", "8")),
+    "ffmpeg": int(Config.get("FFMPEG_CONCURRENCY", "4")),
+}
+# buckets are pruned once there are more than this many of them
+_MAX_BUCKETS = 10000
+
+_REJECTIONS = Metrics().counter("holobot_admission_rejected_total",
+                                "Commands refused before they started")
+
+
+class AdmissionRejected(Exception):
+    """
+    Raised when a command is refused before it starts.
+    The reason is a key of the system locale file.
+    """
+
+    def __init__(self, reason: str, retry_after: float = 0.0):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """
+    A token bucket that refills continuously.
+    """
+
+    def __init__(self, capacity: int, period: float):
+        self._capacity = capacity
+        self._rate = capacity / period
+        self._tokens = float(capacity)
+        self._updated = monotonic()
+        self.notified = False
+
+    def _refill(self, now: float):
+        elapsed = now - self._updated
+        self._tokens = min(self._capacity, self._tokens + elapsed * self._rate)
+        self._updated = now
+
+    def consume(self) -> float:
+        """
+        Take one token.
+
+        :return: 0 if a token was taken, else seconds until the next token
+        """
+        self._refill(monotonic())
+        if self._tokens >= 1:
+            self._tokens -= 1
+            self.notified = False
+            return 0.0
+        return (1 - self._tokens) / self._rate
+
+    @property
+    def is_full(self) -> bool:
+        self._refill(monotonic())
+        return self._tokens >= self._capacity
+
+
+class RateLimiter:
+    """
+    A class that keeps token buckets per user, guild and command.
+    """
+    _instance = None
+    _initialized: bool = False
+
+    def __new__(cls, *args, **kwargs):
+        # single-ton pattern
+        if not cls._instance:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        # single-ton
+        if self._initialized:
+            return
+        self._initialized = True
+        self._buckets: dict[tuple[str, int, str], TokenBucket] = {}
+
+    def _prune(self):
+        # a full bucket behaves like a new one, so it can be dropped
+        for key in [k for k, v in self._buckets.items() if v.is_full]:
+            del self._buckets[key]
+
+    def check(self, command: str, limits: dict[str, tuple[int, float]],
+              user_id: int, guild_id: int):
+        """
+        Consume a token from every bucket of the command.
+
+        :param command: qualified command name
+        :param limits: scope -> (capacity, period in seconds)
+        :param user_id: user id
+        :param guild_id: guild id
+        :raise AdmissionRejected: If any bucket is empty
+        """
+        owners = {"user": user_id, "guild": guild_id, "command": 0}
+        if len(self._buckets) > _MAX_BUCKETS:
+            self._prune()
+        for scope, (capacity, period) in limits.items():
+            key = (scope, owners[scope], command)
+            if key not in self._buckets:
+                self._buckets[key] = TokenBucket(capacity, period)
+            bucket = self._buckets[key]
+            retry_after = bucket.consume()
+            if retry_after:
+                # only the first rejection of a window gets a reply
+                reason = f"RateLimit_{scope.capitalize()}"
+                if bucket.notified:
+                    reason = ""
+                bucket.notified = True
+                raise AdmissionRejected(reason, retry_after)
+
+
+class AdmissionGate:
+    """
+    A class that caps concurrent work on a shared resource.
+    Callers wait in a bounded queue, and no guild can hold more than
+    a few slots so a spike in one guild does not starve the others.
+    """
+    _gates: dict[str, "AdmissionGate"] = {}
+
+    def __init__(self, name: str, limit: int):
+        self._name = name
+        self._semaphore = Semaphore(limit)
+        self._waiting = 0
+        self._in_flight: dict[int, int] = {}
+
+    @staticmethod
+    def get(name: str) -> "AdmissionGate":
+        """
+        Get the gate of a resource.
+
+        :param name: resource name, "s3" or "ffmpeg"
+        :return: gate
+        """
+        if name not in AdmissionGate._gates:
+            gate = AdmissionGate(name, _GATE_LIMITS[name])
+            AdmissionGate._gates[name] = gate
+        return AdmissionGate._gates[name]
+
+    @asynccontextmanager
+    async def slot(self, guild_id: int, reject: bool = True):
+        """
+        Hold a slot of the resource inside the with block.
+
+        :param guild_id: guild id
+        :param reject: If False, wait instead of rejecting
+        :raise AdmissionRejected: If the queue or the guild share is full
+        """
+        if reject and (self._waiting >= _ADMISSION_QUEUE_SIZE or
+                       self._in_flight.get(guild_id, 0) >=
+                       _ADMISSION_GUILD_LIMIT):
+            raise AdmissionRejected("Admission_Busy")
+        self._in_flight[guild_id] = self._in_flight.get(guild_id, 0) + 1
+        try:
+            self._waiting += 1
+            try:
+                await self._semaphore.acquire()
+            finally:
+                self._waiting -= 1
+            try:
+                yield
+            finally:
+                self._semaphore.release()
+        finally:
+            self._in_flight[guild_id] -= 1
+            if not self._in_flight[guild_id]:
+                del self._in_flight[guild_id]
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def waiting(self) -> int:
+        return self._waiting
+
+
+async def _reject(ctx, error: AdmissionRejected):
+    # repeated rejections of a window have no reason, as they get no reply
+    _REJECTIONS.inc(reason=error.reason or "Repeated")
+    if not error.reason:
+        return
+    guild_id = ctx.guild.id if ctx.guild else 0
+    locale = LocaleProperties("system", guild_locale(guild_id))
+    await ctx.send(locale.get(error.reason).format(ceil(error.retry_after)))
+
+
+async def rate_limit_middleware(spec, ctx, call_next):
+    """
+    Dispatch middleware that applies the rate limit and the resource
+    gates declared on a command.
+    """
+    guild_id = ctx.guild.id if ctx.guild else 0
+    try:
+        if spec.rate_limit:
+            RateLimiter().check(spec.name, spec.rate_limit,
+                                ctx.author.id, guild_id)
+        async with _hold(spec.resources, guild_id):
+            return await call_next()
+    except AdmissionRejected as e:
+        await _reject(ctx, e)
+
+
+@asynccontextmanager
+async def _hold(resources: tuple[str, ...], guild_id: int):
+    if not resources:
+        yield
+        return
+    async with AdmissionGate.get(resources[0]).slot(guild_id):
+        async with _hold(resources[1:], guild_id):
+            yield
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+# botlib/sys/shard.py
+
+from asyncio import create_task, sleep
+from botlib.sys.config import Config
+from importlib import import_module
+from multiprocessing import get_context
+from os import environ, getpid
+from queue import Empty
+from time import monotonic
+from time import sleep as block
+
+__all__ = ["ShardSupervisor", "shard_ranges"]
+
+_HEARTBEAT_INTERVAL = 10.0
+_HEARTBEAT_TIMEOUT = float(Config.get("SHARD_HEARTBEAT_TIMEOUT", "120"))
+_REPORT_INTERVAL = float(Config.get("SHARD_REPORT_INTERVAL", "60"))
+_MAX_BACKOFF = 60.0
+# a worker that stays up this long has its restart backoff reset
+_STABLE_UPTIME = 300.0
+# seconds a worker gets to close after SIGTERM before it is killed
+_STOP_TIMEOUT = 10.0
+
+
+def shard_ranges(shard_count: int, processes: int) -> list[list[int]]:
+    """
+    Split the gateway shards into contiguous ranges, one per process.
+
+    :param shard_count: total number of gateway shards
+    :param processes: number of worker processes
+    :return: shard ids per process
+    """
+    processes = max(1, min(processes, shard_count))
+    size, rest = divmod(shard_count, processes)
+    ranges, start = [], 0
+    for index in range(processes):
+        end = start + size + (1 if index < rest else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+
+async def _heartbeat(bot, index: int, health):
+    while not bot.is_closed():
+        health.put({
+            "worker": index, "pid": getpid(), "time": monotonic(),
+            "ready": bot.is_ready(), "guilds": len(bot.guilds),
+            "voice": len(bot.voice_clients),
+            "latencies": {str(k): v for k, v in bot.latencies},
+        })
+        await sleep(_HEARTBEAT_INTERVAL)
+
+
+def _run_worker(factory: str, token: str, index: int, restarts: int,
+                shard_ids: list[int], shard_count: int, health):
+    # every worker gets its own metrics port above the configured one
+    environ["HOLOBOT_WORKER_INDEX"] = str(index)
+    # assets prepared before the first start may be stale after a restart
+    environ["HOLOBOT_WORKER_RESTARTS"] = str(restarts)
+    module, name = factory.split(":")
+    bot = getattr(import_module(module), name)(shard_ids=shard_ids,
+                                               shard_count=shard_count)
+
+    async def start_heartbeat():
+        # on_connect is dispatched again after every reconnect
+        if getattr(bot, "heartbeat_task", None) is None:
+            # keep a reference, or the task may be garbage collected
+            bot.heartbeat_task = create_task(_heartbeat(bot, index, health))
+
+    bot.add_listener(start_heartbeat, "on_connect")
+    bot.run(token)
+
+
+class _Worker:
+    def __init__(self, index: int, shard_ids: list[int]):
+        self.index = index
+        self.shard_ids = shard_ids
+        self.process = None
+        self.started = 0.0
+        self.restarts = 0
+        self.backoff = 1.0
+        self.retry_at = 0.0
+        self.health: dict = {}
+
+
+class ShardSupervisor:
+    """
+    A class that runs gateway shards in worker processes.
+    Crashed or silent workers are restarted with an exponential backoff.
+    """
+
+    def __init__(self, token: str, shard_count: int, processes: int,
+                 factory: str = "app:create_bot"):
+        """
+        :param token: bot token
+        :param shard_count: total number of gateway shards
+        :param processes: number of worker processes
+        :param factory: "module:function" that builds a bot from
+                        shard_ids and shard_count
+        """
+        self._token = token
+        self._shard_count = shard_count
+        self._factory = factory
+        self._context = get_context("spawn")
+        self._health = self._context.Queue()
+        self._workers = [_Worker(i, ids) for i, ids in
+                         enumerate(shard_ranges(shard_count, processes))]
+
+    def _start(self, worker: _Worker):
+        worker.process = self._context.Process(
+            target=_run_worker, name=f"holobot-shard-{worker.index}",
+            args=(self._factory, self._token, worker.index,
+                  worker.restarts, worker.shard_ids, self._shard_count,
+                  self._health))
+        worker.process.start()
+        worker.started = monotonic()
+        worker.health = {}
+        print(f"Worker {worker.index} started with shards "
+              f"{worker.shard_ids} (pid {worker.process.pid}).")
+
+    def _drain_health(self):
+        while True:
+            try:
+                message = self._health.get_nowait()
+            except Empty:
+                return
+            self._workers[message["worker"]].health = message
+
+    def _check(self, worker: _Worker):
+        now = monotonic()
+        process = worker.process
+        if process is not None and process.is_alive():
+            last = worker.health.get("time", worker.started)
+            if now - last < _HEARTBEAT_TIMEOUT:
+                if now - worker.started > _STABLE_UPTIME:
+                    worker.backoff = 1.0
+                return
+            print(f"Worker {worker.index} missed its heartbeat, stopping.")
+            # a worker that still handles signals flushes what it holds
+            process.terminate()
+            process.join(_STOP_TIMEOUT)
+            if process.is_alive():
+                process.kill()
+                process.join()
+        if process is not None:
+            print(f"Worker {worker.index} exited with code "
+                  f"{process.exitcode}, restarting in {worker.backoff:.0f}s.")
+            worker.process = None
+            worker.retry_at = now + worker.backoff
+            worker.backoff = min(worker.backoff * 2, _MAX_BACKOFF)
+            worker.restarts += 1
+        if now >= worker.retry_at:
+            self._start(worker)
+
+    def report(self) -> str:
+        """
+        Format the health of every worker.
+
+        :return: report text
+        """
+        lines = ["Shard health:"]
+        for worker in self._workers:
+            health = worker.health
+            alive = worker.process is not None and worker.process.is_alive()
+            latencies = health.get("latencies", {})
+            latency = max(latencies.values(), default=float("nan"))
+            lines.append(
+                f"  worker {worker.index} shards {worker.shard_ids} "
+                f"{'up' if alive else 'down'} "
+                f"ready={health.get('ready', False)} "
+                f"guilds={health.get('guilds', 0)} "
+                f"voice={health.get('voice', 0)} "
+                f"latency={latency * 1000:.0f}ms "
+                f"restarts={worker.restarts}")
+        return "\n".join(lines)
+
+    def run(self, prepare=None):
+        """
+        Run the workers until interrupted.
+
+        :param prepare: called once before the workers start, to build
+                        assets they share read-only. Restarted workers
+                        see HOLOBOT_WORKER_RESTARTS above 0, and should
+                        not trust assets that may have changed since.
+        """
+        if prepare is not None:
+            prepare()
+        for worker in self._workers:
+            self._start(worker)
+        reported = monotonic()
+        try:
+            while True:
+                block(1)
+                self._drain_health()
+                for worker in self._workers:
+                    self._check(worker)
+                if monotonic() - reported >= _REPORT_INTERVAL:
+                    print(self.report())
+                    reported = monotonic()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for worker in self._workers:
+                if worker.process is not None and worker.process.is_alive():
+                    worker.process.terminate()
+            for worker in self._workers:
+                if worker.process is not None:
+                    worker.process.join()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# botlib/sys/startup.py
+
+from asyncio import Future, create_task, gather, to_thread, wait
+from collections.abc import Callable
+from contextlib import contextmanager
+from time import perf_counter
+
+__all__ = ["StartupTimer", "ready", "warm_up"]
+
+# warm-up builds by factory, so commands can wait for them
+_BUILDS: dict[Callable[[], object], Future] = {}
+
+
+class StartupTimer:
+    """
+    A class that records how long each startup phase takes.
+    """
+
+    def __init__(self):
+        self._origin = perf_counter()
+        self._phases: dict[str, float] = {}
+        self._started: dict[str, float] = {}
+
+    @contextmanager
+    def phase(self, name: str):
+        """
+        Measure the phase that runs inside the with block.
+
+        :param name: phase name
+        """
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop(name)
+
+    def start(self, name: str):
+        """
+        Start measuring a phase that ends in another callback.
+
+        :param name: phase name
+        """
+        self._started[name] = perf_counter()
+
+    def stop(self, name: str):
+        """
+        Stop measuring a phase. Does nothing if it is not running.
+
+        :param name: phase name
+        """
+        if name in self._started:
+            self._phases[name] = perf_counter() - self._started.pop(name)
+
+    @property
+    def phases(self) -> dict[str, float]:
+        return dict(self._phases)
+
+    def report(self) -> str:
+        """
+        Format the startup timing breakdown.
+
+        :return: report text
+        """
+        lines = ["Startup timing:"]
+        for name, elapsed in self._phases.items():
+            lines.append(f"  {name:<24}{elapsed * 1000:10.1f} ms")
+        total = perf_counter() - self._origin
+        lines.append(f"  {'total':<24}{total * 1000:10.1f} ms")
+        return "\n".join(lines)
+
+
+async def warm_up(timer: StartupTimer,
+                  *stages: dict[str, Callable[[], object]]):
+    """
+    Construct singletons in background threads.
+    Stages run in order, and every factory in a stage runs in parallel.
+    A failed factory is reported and left to be built on first use.
+
+    :param timer: timer that receives a phase per factory
+    :param stages: mapping of phase name to factory, per stage
+    """
+    async def run(name: str, factory: Callable[[], object]):
+        timer.start(name)
+        _BUILDS[factory] = build = create_task(to_thread(factory))
+        try:
+            await build
+        except Exception as e:
+            print(f"Warm-up of {name} failed: {e!r}")
+        finally:
+            timer.stop(name)
+
+    for stage in stages:
+        await gather(*[run(name, factory) for name, factory in stage.items()])
+
+
+async def ready(cls: type):
+    """
+    Get a singleton from a command without building it on the event loop.
+    A build the warm-up is running is awaited, and one that never started
+    or failed is done in a worker thread.
+
+    :param cls: singleton class
+    :return: instance
+    """
+    build = _BUILDS.get(cls)
+    if build is not None and not build.done():
+        # a failed build is reported by the warm-up, and retried below
+        await wait({build})
+    instance = cls._instance
+    if instance is None or not instance._initialized:
+        instance = await to_thread(cls)
+    return instance
@@ -1,43 +1,279 @@
 # -*- coding: utf-8 -*-
 # botlib/sys/util.py
 
-from discord.ext.commands import Bot, Command
+from botlib.sys.manager import Locale, LocaleProperties
+from botlib.sys.metrics import metrics_middleware
+from botlib.sys.ratelimit import rate_limit_middleware
+from discord import Embed
+from discord.ext.commands import Bot, Command, Context
+from functools import wraps
+from json import loads as loads_json
+
+__all__ = ["CommandSpec", "discord_command_wrapper", "discord_command",
+           "add_all_commands", "add_all_app_commands",
+           "add_dispatch_middleware", "command_router", "commands_help",
+           "help_index"]
+
+# qualified command name -> spec, for every command added to the bot
+_REGISTERED: dict[str, "CommandSpec"] = {}
+# async (spec, ctx, call_next) callables run around every command
+_MIDDLEWARES: list = [metrics_middleware, rate_limit_middleware]
+
+
+class CommandSpec:
+    """
+    A static description of a command, recorded at class-definition time.
+    """
+
+    def __init__(self, name: str, aliases: tuple[str, ...], func,
+                 bound: bool):
+        self._name = name
+        self._aliases = aliases
+        self._func = func
+        self._bound = bound
+        self._rate_limit = getattr(func, "_discord_command_rate_limit", {})
+        self._resources = getattr(func, "_discord_command_resources", ())
+
+    def with_namespace(self, namespace: str) -> "CommandSpec":
+        """
+        Copy the spec with a namespace in front of every name.
+
+        :param namespace: namespace to prepend
+        :return: new spec
+        """
+        if not namespace:
+            return self
+        return CommandSpec(f"{namespace}.{self._name}",
+                           tuple(f"{namespace}.{i}" for i in self._aliases),
+                           self._func, self._bound)
+
+    def resolve(self, wrapper: object):
+        """
+        Get the callable for this command.
+
+        :param wrapper: command wrapper instance that owns the command
+        :return: callable
+        """
+        if self._bound:
+            return self._func.__get__(wrapper, type(wrapper))
+        return self._func
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def aliases(self) -> tuple[str, ...]:
+        return self._aliases
+
+    @property
+    def func(self):
+        return self._func
+
+    @property
+    def bound(self) -> bool:
+        return self._bound
+
+    @property
+    def rate_limit(self) -> dict[str, tuple[int, float]]:
+        return self._rate_limit
+
+    @property
+    def resources(self) -> tuple[str, ...]:
+        return self._resources
+
+    @property
+    def description(self) -> str:
+        doc = (self._func.__doc__ or "").strip()
+        return doc.splitlines()[0] if doc else self._name
 
 
 def discord_command_wrapper(namespace: str = "", add_namespace: bool = False):
-    def wrapper(obj):
-        obj._discord_command_wrapper = True
-        obj._discord_command_wrapper_namespace = namespace
-        obj._discord_command_wrapper_add_namespace = add_namespace
-        return obj
+    def wrapper(cls):
+        table = []
+        prefix = namespace if add_namespace else ""
+        for value in vars(cls).values():
+            static = isinstance(value, staticmethod)
+            func = value.__func__ if static else value
+            if hasattr(func, "_discord_command"):
+                name = getattr(func, "_discord_command_name")
+                alias = getattr(func, "_discord_command_alias")
+                spec = CommandSpec(name, tuple(alias), func, not static)
+                table.append(spec.with_namespace(prefix))
+            elif (isinstance(value, type) and
+                  hasattr(value, "_discord_command_table")):
+                for spec in getattr(value, "_discord_command_table"):
+                    if spec.bound:
+                        raise TypeError(f"Nested command '{spec.name}' "
+                                        f"must be a staticmethod.")
+                    table.append(spec.with_namespace(namespace))
+        cls._discord_command_wrapper = True
+        cls._discord_command_wrapper_namespace = namespace
+        cls._discord_command_wrapper_add_namespace = add_namespace
+        cls._discord_command_table = tuple(table)
+        return cls
 
     return wrapper
 
 
-def discord_command(command_name: str, alias: tuple[str] = ()):
+def discord_command(command_name: str, alias: tuple[str] = (),
+                    rate_limit: dict[str, tuple[int, float]] | None = None,
+                    resources: tuple[str, ...] = ()):
+    """
+    Mark a function as a command.
+
+    :param command_name: command name
+    :param alias: command aliases
+    :param rate_limit: "user", "guild" or "command" -> (capacity, period)
+    :param resources: shared resources held while running, "s3", "ffmpeg"
+    """
     def wrapper(obj):
         obj._discord_command = True
         obj._discord_command_name = command_name
         obj._discord_command_alias = alias
+        obj._discord_command_rate_limit = rate_limit or {}
+        obj._discord_command_resources = resources
         return obj
 
     return wrapper
 
 
-def add_all_commands(bot: Bot, wrapper: object, base: str = ""):
-    for key in dir(wrapper):
-        attr = getattr(wrapper, key)
-        if hasattr(attr, "_discord_command"):
-            namespace = getattr(wrapper, "_discord_command_wrapper_namespace")
-            name = getattr(attr, "_discord_command_name")
-            alias = getattr(attr, "_discord_command_alias")
-            if getattr(wrapper, "_discord_command_wrapper_add_namespace"):
-                name = f"{base}.{namespace}.{name}"[1:]
-                aliases = tuple([f"{base}.{namespace}.{i}"[1:] for i in alias])
-            else:
-                name = f"{base}.{name}"[1:]
-                aliases = tuple([f"{base}.{i}"[1:] for i in alias])
-            bot.add_command(Command(name=name, aliases=aliases, func=attr))
-        elif hasattr(attr, "_discord_command_wrapper") and key != "__class__":
-            namespace = getattr(wrapper, "_discord_command_wrapper_namespace")
-            add_all_commands(bot, attr, f"{base}.{namespace}")
+def add_dispatch_middleware(middleware, first: bool = False):
+    """
+    Run a middleware around every command added after this call.
+
+    :param middleware: async (spec, ctx, call_next) callable
+    :param first: If True, run it before the existing middlewares
+    """
+    if first:
+        _MIDDLEWARES.insert(0, middleware)
+    else:
+        _MIDDLEWARES.append(middleware)
+
+
+def _dispatcher(spec: CommandSpec, func):
+    middlewares = tuple(_MIDDLEWARES)
+
+    # wraps keeps the signature, which the command parser reads
+    @wraps(func)
+    async def dispatch(ctx: Context, *args, **kwargs):
+        async def call(index: int):
+            if index == len(middlewares):
+                return await func(ctx, *args, **kwargs)
+            return await middlewares[index](spec, ctx,
+                                            lambda: call(index + 1))
+
+        return await call(0)
+
+    # a dotted qualified name reads as a method expecting self
+    dispatch.__qualname__ = dispatch.__name__
+    return dispatch
+
+
+def add_all_commands(bot: Bot, wrapper: object):
+    for spec in getattr(wrapper, "_discord_command_table"):
+        func = _dispatcher(spec, spec.resolve(wrapper))
+        bot.add_command(Command(func, name=spec.name, aliases=spec.aliases))
+        _REGISTERED[spec.name] = spec
+
+
+class _InteractionContext:
+    """
+    The part of a command context the modules use, for a slash command.
+    """
+
+    def __init__(self, bot: Bot, interaction):
+        self.bot = bot
+        self.interaction = interaction
+        self.guild = interaction.guild
+        self.author = interaction.user
+        self.channel = interaction.channel
+
+    @property
+    def voice_client(self):
+        return self.guild.voice_client if self.guild else None
+
+    async def send(self, content: str | None = None, **kwargs):
+        # the interaction was deferred, so every message follows it up
+        return await self.interaction.followup.send(content, **kwargs)
+
+    async def reply(self, content: str | None = None, **kwargs):
+        return await self.send(content, **kwargs)
+
+
+def _app_command(bot: Bot, spec: CommandSpec, func):
+    # the discord shim of nextcord has no application command api
+    from nextcord import Interaction, SlashOption
+
+    async def callback(interaction: Interaction,
+                       arguments: str = SlashOption(
+                           description="Arguments", required=False,
+                           default="")):
+        # commands may take longer than the 3 seconds an interaction waits
+        await interaction.response.defer()
+        await func(_InteractionContext(bot, interaction), *arguments.split())
+
+    # dots are not allowed in application command names
+    name = spec.name.replace(".", "-").lower()
+    bot.slash_command(name=name,
+                      description=spec.description[:100])(callback)
+
+
+def add_all_app_commands(bot: Bot, wrapper: object):
+    """
+    Register the commands of a wrapper as slash commands.
+    They are uploaded when the bot connects.
+
+    :param bot: bot
+    :param wrapper: command wrapper instance
+    """
+    for spec in getattr(wrapper, "_discord_command_table"):
+        _app_command(bot, spec, _dispatcher(spec, spec.resolve(wrapper)))
+
+
+def command_router(name: str, commands: tuple[str, ...]) \
+        -> dict[Locale, dict[str, str]]:
+    """
+    Build the sub-command routing table of every locale once.
+
+    :param name: locale file name
+    :param commands: sub-command keys, e.g. "Play" for "Command_Play"
+    :return: locale -> alias -> sub-command key
+    """
+    routes = {}
+    for locale in Locale:
+        properties = LocaleProperties(name, locale)
+        routes[locale] = {}
+        for command in commands:
+            aliases = properties.get(f"Command_{command}")
+            if aliases == "NaN":
+                continue
+            for alias in eval(aliases):
+                # earlier sub-commands win, as in a match statement
+                routes[locale].setdefault(alias.lower(), command)
+    return routes
+
+
+async def commands_help(ctx: Context, locale: LocaleProperties):
+    embed = Embed(title=locale.get("Help_Title"), color=0x82e6e6)
+    descriptions = loads_json(locale.get("Help_Field"))
+    for description in descriptions:
+        description["value"] = "\n".join(description["value"])
+        embed.add_field(**description, inline=False)
+    await ctx.send(embed=embed)
+
+
+def help_index() -> list[str]:
+    """
+    Generate the help index of every registered command.
+
+    :return: one line per command
+    """
+    lines = []
+    for name in sorted(_REGISTERED):
+        spec = _REGISTERED[name]
+        line = f"!{name}"
+        if spec.aliases:
+            line += f" ({', '.join(spec.aliases)})"
+        lines.append(line)
+    return lines